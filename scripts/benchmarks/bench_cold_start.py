@@ -0,0 +1,67 @@
+# Cold-start time of every entry point: a fresh interpreter running `script --help`, which imports
+# everything the script imports at the top and parses its arguments, but loads no data, model or
+# tokenizer. Reports the median over --repeats runs and, from `python -X importtime`, the top-level
+# imports that take the longest. The NLTK resource check (nltk_resources.ensure_punkt) is timed on its
+# own with NLTK_OFFLINE set, so it never touches the network.
+#   python bench_cold_start.py --repeats 5
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+import numpy as np
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ENTRY_POINTS = ['data_gen/gpt_qg.py', 'data_gen/gpt_qa.py', 'data_gen/do_consolidation.py', 'data_gen/rethreshold.py',
+                'data_gen/run_pipeline.py',
+                'prompt_standard_llm.py', 'prompt_longcontext_llm.py']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--entry_points', type=str, nargs='+', default=ENTRY_POINTS, help="Scripts relative to scripts/.")
+parser.add_argument('--repeats', type=int, default=5)
+parser.add_argument('--top_imports', type=int, default=3, help="Slowest top-level imports to list per entry point.")
+args = parser.parse_args()
+
+# "import time: self [us] | cumulative | imported package", nested imports are indented.
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+
+def timed_run(command, env):
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=SCRIPTS_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - start, result
+
+
+def slowest_imports(command, env):
+    _, result = timed_run([sys.executable, '-X', 'importtime'] + command[1:], env)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and not match.group(3):
+            imports.append((int(match.group(2)) / 1e6, match.group(4)))
+    return sorted(imports, reverse=True)[:args.top_imports]
+
+
+def report(name, command, env):
+    times = []
+    for _ in range(args.repeats):
+        elapsed, result = timed_run(command, env)
+        if result.returncode != 0:
+            print(f"{name}: failed\n" + '\n'.join(result.stderr.splitlines()[-5:]))
+            return
+        times.append(elapsed)
+    slowest = ', '.join(f"{module} {seconds:.2f}s" for seconds, module in slowest_imports(command, env))
+    print(f"{name}: median {np.median(times):.2f}s, min {min(times):.2f}s over {args.repeats} runs; slowest imports: {slowest}")
+
+
+def main():
+    # The API key is only read, never used: no request is made.
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'unused'), NLTK_OFFLINE='1')
+    for entry_point in args.entry_points:
+        report(entry_point, [sys.executable, entry_point, '--help'], env)
+    report('nltk_resources.ensure_punkt', [sys.executable, '-c', 'from nltk_resources import ensure_punkt; ensure_punkt()'], env)
+
+
+if __name__ == "__main__":
+    main()
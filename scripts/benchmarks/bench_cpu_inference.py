@@ -0,0 +1,68 @@
+# Accuracy-vs-speed check of the CPU inference modes of ConsolidationModel.
+# Samples held-out answer pairs from a gpt_qa.py output, scores them with the fp32 model and with the
+# int8 dynamically quantized model on CPU, and reports pairs/sec for each, the score differences against
+# fp32 (mean/max absolute error, Pearson correlation) and how often the link decision at --thresh agrees.
+# Only switch consolidation to --quantize if the decision agreement is close to 100% for your data.
+#   python bench_cpu_inference.py --generated_answer_path answers.jsonl --num_pairs 2000 --num_threads 8
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_gen'))
+from corpus import iter_records
+from model_consolidation import ConsolidationModel
+from do_consolidation import parse_answers
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--generated_answer_path', type=str, required=True, help="The file produced by gpt_qa.py.")
+parser.add_argument('--model_card', type=str, default='Salesforce/qa_consolidation')
+parser.add_argument('--num_pairs', type=int, default=2000)
+parser.add_argument('--num_threads', type=int, default=None)
+parser.add_argument('--thresh', type=float, default=2.75)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+# (question, answer1, answer2) for every ordered pair of distinct answers of each record.
+def answer_pairs(records):
+    for record in records:
+        answers = [answer for article_answers in record['answers'] for answer in parse_answers(article_answers)]
+        for a1 in answers:
+            for a2 in answers:
+                if a1 != a2:
+                    yield record['question'], a1, a2
+
+
+def run(model, pairs):
+    questions, answers1, answers2 = zip(*pairs)
+    # Warm up so the timed run does not pay for lazy initialization.
+    model.score_batch(questions[:8], answers1[:8], answers2[:8], contexts1=None)
+    start = time.perf_counter()
+    scores = model.score_batch(list(questions), list(answers1), list(answers2), contexts1=None)["scores"]
+    return np.array(scores), time.perf_counter() - start
+
+
+def main():
+    pairs = list(answer_pairs(iter_records(args.generated_answer_path)))
+    random.Random(args.seed).shuffle(pairs)
+    pairs = pairs[:args.num_pairs]
+
+    fp32 = ConsolidationModel(model_card=args.model_card, device='cpu', num_threads=args.num_threads)
+    reference, reference_time = run(fp32, pairs)
+    print(f"{len(pairs)} pairs, fp32: {len(pairs) / reference_time:.1f} pairs/sec")
+
+    int8 = ConsolidationModel(model_card=args.model_card, device='cpu', num_threads=args.num_threads, quantize=True)
+    scores, int8_time = run(int8, pairs)
+    error = np.abs(scores - reference)
+    agreement = np.mean((scores > args.thresh) == (reference > args.thresh))
+    print(f"int8: {len(pairs) / int8_time:.1f} pairs/sec ({reference_time / int8_time:.2f}x), "
+          f"abs error mean {error.mean():.4f} max {error.max():.4f}, "
+          f"correlation {np.corrcoef(scores, reference)[0, 1]:.4f}, link decisions agree {agreement:.2%}")
+
+
+if __name__ == "__main__":
+    main()
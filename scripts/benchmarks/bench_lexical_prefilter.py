@@ -0,0 +1,84 @@
+# Benchmark the lexical pre-filter of ConsolidationModel on answers produced by gpt_qa.py.
+# For a sample of questions, consolidates the answers exhaustively and with the pre-filter, and reports
+# the speedup, the share of pairs skipped and how well the resulting answer_groups agree
+# (exact match rate and pairwise Rand index).
+#   python bench_lexical_prefilter.py --generated_answer_path answers.jsonl --prefilter tfidf --floors 0.02 0.05 0.1
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import combinations
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_gen'))
+from corpus import iter_records
+from model_consolidation import ConsolidationModel
+from do_consolidation import record_paragraphs
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--generated_answer_path', type=str, required=True, help="The file produced by gpt_qa.py.")
+parser.add_argument('--model_card', type=str, default='Salesforce/qa_consolidation')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--prefilter', type=str, default='tfidf', choices=['tfidf', 'jaccard'])
+parser.add_argument('--floors', type=float, nargs='+', default=[0.02, 0.05, 0.1])
+parser.add_argument('--num_questions', type=int, default=200)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+def group_labels(answer_groups, paragraphs):
+    labels = {}
+    for group_idx, group in enumerate(answer_groups):
+        for answer in group:
+            labels[answer] = group_idx
+    return [labels[p['answer']] for p in paragraphs]
+
+
+def rand_index(labels1, labels2):
+    pairs = list(combinations(range(len(labels1)), 2))
+    if not pairs:
+        return 1.0
+    agree = sum((labels1[i] == labels1[j]) == (labels2[i] == labels2[j]) for i, j in pairs)
+    return agree / len(pairs)
+
+
+def run(model, samples):
+    start = time.perf_counter()
+    results = [model.consolidate(question=record['question'], paragraphs=paragraphs) for record, paragraphs in samples]
+    return results, time.perf_counter() - start
+
+
+def main():
+    records = [record for record in iter_records(args.generated_answer_path)]
+    random.Random(args.seed).shuffle(records)
+    samples = []
+    for record in records:
+        paragraphs = record_paragraphs(record['aids'], record['answers'])
+        if len(paragraphs) > 1:
+            samples.append((record, paragraphs))
+        if len(samples) == args.num_questions:
+            break
+
+    model = ConsolidationModel(model_card=args.model_card, device=args.device)
+    # Warm up so the first timed run does not pay for lazy initialization.
+    run(model, samples[:1])
+    model.prefilter = None
+    exhaustive, exhaustive_time = run(model, samples)
+    print(f"{len(samples)} questions, exhaustive: {exhaustive_time:.1f}s")
+
+    model.prefilter = args.prefilter
+    for floor in args.floors:
+        model.prefilter_floor = floor
+        model.stats = {key: 0 for key in model.stats}
+        filtered, filtered_time = run(model, samples)
+        exact = sum(a == b for a, b in zip(exhaustive, filtered)) / len(samples)
+        rand = sum(rand_index(group_labels(a, paragraphs), group_labels(b, paragraphs))
+                   for a, b, (_, paragraphs) in zip(exhaustive, filtered, samples)) / len(samples)
+        pruned = model.stats['pairs_pruned'] / max(model.stats['pairs_after_dedup'], 1)
+        print(f"{args.prefilter} floor={floor}: {filtered_time:.1f}s ({exhaustive_time / filtered_time:.2f}x), "
+              f"pairs pruned {pruned:.1%}, identical answer_groups {exact:.1%}, Rand index {rand:.3f}")
+
+
+if __name__ == "__main__":
+    main()
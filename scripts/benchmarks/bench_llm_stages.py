@@ -0,0 +1,121 @@
+# End-to-end throughput benchmark of the API-calling scripts against the local stub (llm_stub_server.py).
+# Builds a synthetic corpus in a temporary directory, runs each stage as a subprocess with
+# OPENAI_API_BASE pointing at the stub and the response cache disabled, and reports events/sec, API
+# calls per event (including retried 429s and rejected over-long prompts) and p50/p99 request latency.
+#   python bench_llm_stages.py --num_events 20 --latency_median 0.2 --rate_limit_prob 0.02
+#   python bench_llm_stages.py --stages gpt_qa --extra_args="--questions_per_call 4"
+import argparse
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from llm_stub_server import add_stub_args, config_from_args, start_server
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STAGES = ['gpt_qg', 'gpt_qa', 'prompt_standard_llm', 'prompt_longcontext_llm']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES)
+parser.add_argument('--num_events', type=int, default=20)
+parser.add_argument('--articles_per_event', type=int, default=5)
+parser.add_argument('--questions_per_event', type=int, default=5)
+parser.add_argument('--article_sentences', type=int, default=30)
+parser.add_argument('--max_concurrency', type=int, default=8)
+parser.add_argument('--extra_args', type=str, default='', help="Extra arguments passed to every stage.")
+parser.add_argument('--workdir', type=str, default=None, help="Keep the corpus and outputs here instead of a temporary directory.")
+add_stub_args(parser)
+args = parser.parse_args()
+
+WORDS = ("officials said the storm flooded city center police reported three people injured after fire "
+         "broke out near station residents were evacuated while investigators examined damage").split()
+
+
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + '.'
+
+
+def write_jsonl(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+# Synthetic inputs of every stage, all derived from the same events.
+def build_corpus(workdir):
+    rng = random.Random(args.seed)
+    articles, events, questions, generated_questions, diverse_summ = [], [], [], [], []
+    for eid in range(args.num_events):
+        aids = [f'{eid}-{idx}' for idx in range(args.articles_per_event)]
+        contents = [' '.join(sentence(rng) for _ in range(args.article_sentences)) for _ in aids]
+        articles.extend({'_id': aid, 'content': content} for aid, content in zip(aids, contents))
+        events.append({'_id': eid, 'aids': aids})
+        questions.append({'event_id': eid, 'clusters': [[{'aid': aid}] for aid in aids]})
+        generated_questions.append({'eid': eid, 'aids': aids,
+                                    'questions': [f'What did source {idx} report about event {eid}?' for idx in range(args.questions_per_event)]})
+        diverse_summ.append({'eid': eid, 'articles': [{'content': content} for content in contents]})
+
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'scripts'), exist_ok=True)
+    write_jsonl(os.path.join(workdir, 'articles.jsonl'), articles)
+    write_jsonl(os.path.join(workdir, 'events.jsonl'), events)
+    write_jsonl(os.path.join(workdir, 'questions.jsonl'), questions)
+    write_jsonl(os.path.join(workdir, 'generated_questions.jsonl'), generated_questions)
+    # prompt_*_llm.py read ../data/diverse_summ.json relative to their working directory.
+    with open(os.path.join(workdir, 'data', 'diverse_summ.json'), 'w') as f:
+        json.dump(diverse_summ, f)
+
+
+def stage_command(stage, workdir):
+    output_path = os.path.join(workdir, f'{stage}.jsonl')
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    command = {
+        'gpt_qg': ['data_gen/gpt_qg.py', '--questions_path', 'questions.jsonl', '--events_path', 'events.jsonl',
+                   '--articles_path', 'articles.jsonl'],
+        'gpt_qa': ['data_gen/gpt_qa.py', '--generated_question_path', 'generated_questions.jsonl',
+                   '--articles_path', 'articles.jsonl'],
+        'prompt_standard_llm': ['prompt_standard_llm.py', '--extraction_cache_path', ''],
+        'prompt_longcontext_llm': ['prompt_longcontext_llm.py'],
+    }[stage]
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, command[0])] + [
+        os.path.join(workdir, arg) if arg.endswith('.jsonl') else arg for arg in command[1:]]
+    return command + ['--output_path', output_path, '--cache_path', '', '--max_concurrency', str(args.max_concurrency)] + shlex.split(args.extra_args)
+
+
+def report(stage, elapsed, requests):
+    latencies = np.array([request['latency'] for request in requests if request['status'] == 200])
+    statuses = [request['status'] for request in requests]
+    p50, p99 = (np.percentile(latencies, 50), np.percentile(latencies, 99)) if len(latencies) else (0.0, 0.0)
+    print(f"{stage}: {args.num_events / elapsed:.2f} events/sec ({elapsed:.1f}s), "
+          f"{len(requests) / args.num_events:.1f} calls/event ({statuses.count(429)} rate limited, {statuses.count(400)} too long), "
+          f"latency p50 {p50:.2f}s p99 {p99:.2f}s")
+
+
+def main():
+    server, api_base = start_server(config_from_args(args))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = os.path.abspath(args.workdir or tmpdir)
+        build_corpus(workdir)
+        env = dict(os.environ, OPENAI_API_KEY='stub', OPENAI_API_BASE=api_base)
+        for stage in args.stages:
+            server.log.clear()
+            start = time.perf_counter()
+            result = subprocess.run(stage_command(stage, workdir), cwd=os.path.join(workdir, 'scripts'), env=env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            elapsed = time.perf_counter() - start
+            if result.returncode != 0:
+                print(f"{stage} failed:\n" + '\n'.join(result.stderr.splitlines()[-10:]))
+                continue
+            report(stage, elapsed, list(server.log))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
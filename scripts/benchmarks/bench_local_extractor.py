@@ -0,0 +1,96 @@
+# Compare the local extractor (local_extractor.py) with the LLM extraction stage of prompt_standard_llm.py.
+# Runs the local extractor on every event of the dataset and reports its wall-clock time next to the
+# API calls, estimated tokens and cost of the LLM extractor. Given the output of a
+# `prompt_standard_llm.py --extractor llm` run, it also reports how much of the LLM's selection the local
+# one recovers: the share of LLM sentences selected verbatim, and unigram recall of the LLM sentences.
+#   python bench_local_extractor.py --data_path ../../data/diverse_summ.json --llm_output_path summaries.jsonl
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from context_fitting import estimate_prompt_tokens, prompt_budget
+from jsonl_io import read_jsonl_output
+import local_extractor
+from nltk_resources import ensure_punkt
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', type=str, default="../../data/diverse_summ.json")
+parser.add_argument('--llm_output_path', type=str, default=None, help="Output of prompt_standard_llm.py --extractor llm.")
+parser.add_argument('--num_sentences', type=int, default=10)
+parser.add_argument('--prompt_price', type=float, default=0.03, help="USD per 1K prompt tokens.")
+parser.add_argument('--completion_price', type=float, default=0.06, help="USD per 1K completion tokens.")
+parser.add_argument('--llm_seconds_per_call', type=float, default=None, help="Measured latency of an extraction call, to estimate the LLM wall-clock.")
+args = parser.parse_args()
+
+# Tokens of the extraction instructions and system message around the article.
+EXTRACTION_OVERHEAD_TOKENS = 120
+# Completion tokens assumed per extracted sentence when no LLM output is given.
+TOKENS_PER_SENTENCE = 30
+
+SENTENCE_PREFIX = re.compile(r"^\s*Sentence \d+\s*:\s*")
+
+
+def normalize(sentence):
+    return " ".join(re.findall(r"\w+", SENTENCE_PREFIX.sub("", sentence).lower()))
+
+
+def unigram_recall(reference, candidate):
+    reference = Counter(" ".join(reference).split())
+    candidate = Counter(" ".join(candidate).split())
+    total = sum(reference.values())
+    return sum((reference & candidate).values()) / total if total else 1.0
+
+
+def main():
+    ensure_punkt()
+    with open(args.data_path) as f:
+        events = json.load(f)
+
+    start = time.perf_counter()
+    local = {event['eid']: local_extractor.extract_sentences([article['content'] for article in event['articles']],
+                                                             num_sentences=args.num_sentences)
+             for event in events}
+    local_time = time.perf_counter() - start
+    num_calls = sum(len(event['articles']) for event in events)
+    print(f"local: {len(events)} events, {num_calls} articles in {local_time:.2f}s "
+          f"({1000 * local_time / max(len(events), 1):.1f} ms/event), 0 API calls")
+
+    llm = {record['eid']: record['extracted_sentences'] for record in read_jsonl_output(args.llm_output_path)} if args.llm_output_path else {}
+    prompt_tokens = sum(min(estimate_prompt_tokens([{'role': 'user', 'content': article['content']}]) + EXTRACTION_OVERHEAD_TOKENS,
+                            prompt_budget('gpt-4'))
+                        for event in events for article in event['articles'])
+    if llm:
+        completion_tokens = sum(estimate_prompt_tokens([{'role': 'assistant', 'content': '\n'.join(sentences)}])
+                                for extracted in llm.values() for sentences in extracted)
+        # Scale to the whole dataset if the LLM output covers only part of it.
+        completion_tokens = completion_tokens * num_calls / max(sum(len(extracted) for extracted in llm.values()), 1)
+    else:
+        completion_tokens = num_calls * args.num_sentences * TOKENS_PER_SENTENCE
+    cost = prompt_tokens / 1000 * args.prompt_price + completion_tokens / 1000 * args.completion_price
+    line = f"llm: {num_calls} API calls, ~{prompt_tokens} prompt + ~{int(completion_tokens)} completion tokens, ~${cost:.2f}"
+    if args.llm_seconds_per_call is not None:
+        line += f", ~{num_calls * args.llm_seconds_per_call / 60:.1f} min of sequential calls"
+    print(line)
+
+    if llm:
+        verbatim, recall, num_articles = 0.0, 0.0, 0
+        for eid, extracted in llm.items():
+            for llm_sentences, local_sentences in zip(extracted, local.get(eid, [])):
+                reference = [normalize(s) for s in llm_sentences if normalize(s)]
+                candidate = [normalize(s) for s in local_sentences]
+                if not reference:
+                    continue
+                verbatim += sum(s in set(candidate) for s in reference) / len(reference)
+                recall += unigram_recall(reference, candidate)
+                num_articles += 1
+        print(f"overlap on {num_articles} articles: LLM sentences selected verbatim {verbatim / max(num_articles, 1):.1%}, "
+              f"unigram recall {recall / max(num_articles, 1):.1%}")
+
+
+if __name__ == "__main__":
+    main()
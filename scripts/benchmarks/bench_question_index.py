@@ -0,0 +1,77 @@
+# Benchmark selecting each event's questions in gpt_qg.process_event:
+# a linear scan of the question list per event versus the event_id-keyed GroupedIndex.
+# Uses a synthetic questions file, e.g.  python bench_question_index.py --num_events 10000
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from corpus import GroupedIndex, iter_records
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_events', type=int, default=10000)
+parser.add_argument('--questions_per_event', type=int, default=10)
+parser.add_argument('--scan_sample', type=int, default=200, help="Events timed for the linear scan, which is extrapolated.")
+args = parser.parse_args()
+
+
+def write_questions(path):
+    with open(path, 'w') as f:
+        for q_idx in range(args.questions_per_event):
+            for e_idx in range(args.num_events):
+                f.write(json.dumps({
+                    '_id': f'q{e_idx}_{q_idx}',
+                    'event_id': f'e{e_idx}',
+                    'clusters': [[{'aid': f'a{e_idx}_{c}'}] for c in range(5)],
+                }) + '\n')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'questions.jsonl')
+        write_questions(path)
+        event_ids = [f'e{e_idx}' for e_idx in range(args.num_events)]
+
+        start = time.perf_counter()
+        questions = list(iter_records(path))
+        load_time = time.perf_counter() - start
+
+        sample = event_ids[:args.scan_sample]
+        start = time.perf_counter()
+        for event_id in sample:
+            this_questions = [q for q in questions if q['event_id'] == event_id]
+        scan_time = (time.perf_counter() - start) * len(event_ids) / len(sample)
+
+        start = time.perf_counter()
+        event2questions = {}
+        for q in questions:
+            event2questions.setdefault(q['event_id'], []).append(q)
+        for event_id in event_ids:
+            this_questions = event2questions[event_id]
+        dict_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = GroupedIndex(path, key='event_id')
+        build_time = time.perf_counter() - start
+        index.close()
+
+        start = time.perf_counter()
+        index = GroupedIndex(path, key='event_id')
+        for event_id in event_ids:
+            this_questions = index[event_id]
+        sidecar_time = time.perf_counter() - start
+        index.close()
+
+    print(f"{args.num_events} events x {args.questions_per_event} questions")
+    print(f"load question list:            {load_time:8.2f}s")
+    print(f"linear scan per event (extrap): {scan_time:8.2f}s")
+    print(f"in-memory event_id dict:        {dict_time:8.2f}s")
+    print(f"GroupedIndex build:             {build_time:8.2f}s")
+    print(f"GroupedIndex from sidecar:      {sidecar_time:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Recall of `gpt_qa.py --relevance_cutoff` measured against an unfiltered gpt_qa.py run, without API calls.
+# For a sample of events of the unfiltered output, every (question, article) pair is scored as the filter
+# would score it. At each cutoff the script reports the share of calls the filter saves and how many of
+# the pairs the LLM did answer it would have kept (pair recall), also weighted by the number of answers.
+#   python bench_relevance_filter.py --answers_path generated_answers.jsonl --articles_path articles.json --cutoffs 0.05 0.1 0.2 0.3
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_gen'))
+from corpus import ArticleIndex, iter_records
+from lexical_filter import article_relevance
+from do_consolidation import parse_answers
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--answers_path', type=str, required=True, help="Output of gpt_qa.py run without --relevance_cutoff.")
+parser.add_argument('--articles_path', type=str, default="PATH/TO/ARTICLES.json")
+parser.add_argument('--cutoffs', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.3, 0.5])
+parser.add_argument('--num_events', type=int, default=50, help="Events sampled from the answers file.")
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+def main():
+    eid2records = {}
+    for record in iter_records(args.answers_path):
+        eid2records.setdefault(record['eid'], []).append(record)
+    eids = sorted(eid2records, key=str)
+    sample = random.Random(args.seed).sample(eids, min(args.num_events, len(eids)))
+
+    aid2article = ArticleIndex(args.articles_path)
+    relevance, num_answers = [], []
+    scoring_time = 0.0
+    for eid in sample:
+        records = eid2records[eid]
+        articles = [aid2article[aid]['content'] for aid in records[0]['aids']]
+        start = time.perf_counter()
+        relevance.append(article_relevance([record['question'] for record in records], articles).ravel())
+        scoring_time += time.perf_counter() - start
+        num_answers.append(np.array([len(parse_answers(answers)) for record in records for answers in record['answers']]))
+    aid2article.close()
+
+    relevance, num_answers = np.concatenate(relevance), np.concatenate(num_answers)
+    answered = num_answers > 0
+    print(f"{len(sample)} events, {len(relevance)} (question, article) calls, {answered.sum()} answered "
+          f"({answered.mean():.1%}); scoring took {1000 * scoring_time / max(len(sample), 1):.1f} ms/event")
+    for cutoff in args.cutoffs:
+        kept = relevance >= cutoff
+        print(f"cutoff {cutoff:.2f}: {1 - kept.mean():.1%} of calls skipped, "
+              f"pair recall {kept[answered].sum() / max(answered.sum(), 1):.1%}, "
+              f"answer recall {num_answers[kept].sum() / max(num_answers.sum(), 1):.1%}")
+
+
+if __name__ == "__main__":
+    main()
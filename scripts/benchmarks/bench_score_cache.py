@@ -0,0 +1,63 @@
+# Check and time the pair score cache of ConsolidationModel on answers produced by gpt_qa.py.
+# A sample of questions is consolidated twice with a fresh ScoreCache: the first run scores every pair
+# with the model and fills the cache, the second finds all of them in it. The answer_groups of both runs
+# must be identical (the script fails otherwise); the speedup and hit rate of the second run are reported.
+#   python bench_score_cache.py --generated_answer_path answers.jsonl --device cpu
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_gen'))
+from corpus import iter_records
+from model_consolidation import ConsolidationModel
+from score_cache import ScoreCache
+from do_consolidation import record_paragraphs
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--generated_answer_path', type=str, required=True, help="The file produced by gpt_qa.py.")
+parser.add_argument('--model_card', type=str, default='Salesforce/qa_consolidation')
+parser.add_argument('--device', type=str, default='cuda')
+parser.add_argument('--num_questions', type=int, default=200)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+def run(model, samples):
+    start = time.perf_counter()
+    results = [model.consolidate(question=question, paragraphs=paragraphs) for question, paragraphs in samples]
+    return results, time.perf_counter() - start
+
+
+def main():
+    records = [record for record in iter_records(args.generated_answer_path)]
+    random.Random(args.seed).shuffle(records)
+    samples = []
+    for record in records:
+        paragraphs = record_paragraphs(record['aids'], record['answers'])
+        if len(paragraphs) > 1:
+            samples.append((record['question'], paragraphs))
+        if len(samples) == args.num_questions:
+            break
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ScoreCache(os.path.join(tmpdir, 'scores.sqlite'), model_id=args.model_card)
+        model = ConsolidationModel(model_card=args.model_card, device=args.device, score_cache=cache)
+        cold, cold_time = run(model, samples)
+        model.stats = {key: 0 for key in model.stats}
+        warm, warm_time = run(model, samples)
+        cache.close()
+
+    mismatches = sum(a != b for a, b in zip(cold, warm))
+    lookups = model.stats['pairs_after_dedup'] - model.stats['pairs_pruned']
+    print(f"{len(samples)} questions, cold cache: {cold_time:.1f}s, warm cache: {warm_time:.1f}s "
+          f"({cold_time / max(warm_time, 1e-9):.2f}x), hit rate {model.stats['cache_hits'] / max(lookups, 1):.1%}, "
+          f"pairs scored by the model on the warm run {model.stats['pairs_scored']}")
+    assert mismatches == 0, f"{mismatches} of {len(samples)} questions consolidated differently with a warm score cache"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# Local OpenAI-compatible stub of the chat completions endpoint, for exercising the scripts without an
+# API key or spend. Point the scripts at it with OPENAI_API_BASE=http://127.0.0.1:PORT/v1.
+# Responses are canned but deterministic (seeded by the prompt) and follow the formats the scripts
+# parse: 'Sentence N:' extractions, 'Answer N:' / 'No Answer' answers (with 'Question N:' headers for
+# batched prompts), 'Task 1'/'Task 2' question lists and 'Summary:' summaries. Latency is drawn from a
+# log-normal distribution plus a per-completion-token term, and 429s and context-length errors can be
+# injected. GET /stats returns the per-request log, POST /reset clears it.
+#   python llm_stub_server.py --port 8765 --latency_median 0.5 --rate_limit_prob 0.05
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from context_fitting import CONTEXT_WINDOWS, TOKENS_PER_MESSAGE
+
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+QUESTION_HEADER = re.compile(r'Question (\d+): ')
+
+
+class StubConfig:
+    def __init__(self, latency_median=0.5, latency_sigma=0.5, latency_per_token=0.0, rate_limit_prob=0.0,
+                 chars_per_token=3.0, no_answer_prob=0.3, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.latency_per_token = latency_per_token
+        self.rate_limit_prob = rate_limit_prob
+        # Characters per token used to decide whether a prompt exceeds the model's context window.
+        # Lower than the scripts' own estimate, so that some of their prompts are rejected.
+        self.chars_per_token = chars_per_token
+        self.no_answer_prob = no_answer_prob
+        self.seed = seed
+
+
+def prompt_tokens(messages, chars_per_token):
+    return int(sum(len(message['content']) for message in messages) / chars_per_token) + TOKENS_PER_MESSAGE * len(messages)
+
+
+# Sentences of the material a prompt carries: its longest '===='-separated part, or the article messages
+# before the task description of gpt_qg.py prompts.
+def article_sentences(messages):
+    text = max(re.split(r'={3,}', messages[-1]['content']), key=len)
+    if len(messages) > 1 and 'Task 1' in messages[-1]['content']:
+        text = ' '.join(message['content'] for message in messages[1:-1])
+    return [s.strip() for s in SENTENCE_SPLIT.split(' '.join(text.split())) if s.strip()] or ['Nothing happened.']
+
+
+def answers(rng, sentences, no_answer_prob):
+    if rng.random() < no_answer_prob:
+        return 'No Answer'
+    picked = rng.sample(sentences, min(len(sentences), rng.randint(1, 3)))
+    return ' \n '.join(f'Answer {idx + 1}: {sentence}' for idx, sentence in enumerate(picked))
+
+
+# Canned completion in the format the prompt asks for.
+def canned_response(messages, config):
+    content = messages[-1]['content']
+    rng = random.Random(hashlib.sha1((str(config.seed) + json.dumps(messages)).encode('utf-8')).hexdigest())
+    sentences = article_sentences(messages)
+    if 'Task 1' in content and 'Task 2' in content:
+        factual = '\n'.join(f'{idx + 1}. What happened in sentence {rng.randint(1, 99)}?' for idx in range(5))
+        opinion = '\n'.join(f'{idx + 1}. Why might sources disagree about point {rng.randint(1, 99)}?' for idx in range(15))
+        return f'Task 1:\n{factual}\n\nTask 2:\n{opinion}'
+    # Summary prompts of prompt_standard_llm.py also carry 'Sentence N:' lines.
+    if 'Summary:' in content:
+        return 'Summary: ' + ' '.join(rng.sample(sentences, min(len(sentences), 5)))
+    if 'Sentence 1:' in content:
+        picked = sentences[:10]
+        return ' \n '.join(f'Sentence {idx + 1}: {sentence}' for idx, sentence in enumerate(picked))
+    # The format example in the instructions repeats some headers.
+    numbers = list(dict.fromkeys(QUESTION_HEADER.findall(content)))
+    if numbers:
+        return '\n'.join(f'Question {number}: \n {answers(rng, sentences, config.no_answer_prob)}' for number in numbers)
+    return answers(rng, sentences, config.no_answer_prob)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.server.lock:
+                self.send_json(200, {'requests': list(self.server.log)})
+        else:
+            self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path.rstrip('/').endswith('/reset'):
+            with self.server.lock:
+                self.server.log.clear()
+            return self.send_json(200, {})
+
+        config = self.server.config
+        with self.server.lock:
+            draw = self.server.rng.random()
+            latency = config.latency_median * self.server.rng.lognormvariate(0, config.latency_sigma)
+        model = body.get('model', 'gpt-4')
+        messages = body['messages']
+        num_prompt_tokens = prompt_tokens(messages, config.chars_per_token)
+        if draw < config.rate_limit_prob:
+            status, payload = 429, {'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+        elif num_prompt_tokens > CONTEXT_WINDOWS.get(model, 8192):
+            status, payload = 400, {'error': {'message': f"This model's maximum context length is {CONTEXT_WINDOWS.get(model, 8192)} tokens. "
+                                                         f"However, your messages resulted in {num_prompt_tokens} tokens.",
+                                              'type': 'invalid_request_error', 'code': 'context_length_exceeded'}}
+        else:
+            content = canned_response(messages, config)
+            num_completion_tokens = prompt_tokens([{'content': content}], config.chars_per_token)
+            latency += config.latency_per_token * num_completion_tokens
+            status, payload = 200, {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': num_prompt_tokens, 'completion_tokens': num_completion_tokens,
+                          'total_tokens': num_prompt_tokens + num_completion_tokens}}
+        if status != 429:
+            time.sleep(latency)
+        self.send_json(status, payload)
+        with self.server.lock:
+            self.server.log.append({'status': status, 'model': model, 'latency': time.perf_counter() - start,
+                                    'prompt_tokens': num_prompt_tokens})
+
+    def log_message(self, *args):
+        pass
+
+
+# Server bound to 127.0.0.1:port (0 picks a free port, see server.server_address).
+def make_server(config, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.rng = random.Random(config.seed)
+    server.log = []
+    server.lock = threading.Lock()
+    return server
+
+
+# Start a server on a background thread; returns it and its OPENAI_API_BASE.
+def start_server(config, port=0):
+    server = make_server(config, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+
+def add_stub_args(parser):
+    parser.add_argument('--latency_median', type=float, default=0.5, help="Median request latency in seconds.")
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help="Sigma of the log-normal latency distribution.")
+    parser.add_argument('--latency_per_token', type=float, default=0.0, help="Extra seconds per completion token.")
+    parser.add_argument('--rate_limit_prob', type=float, default=0.0, help="Probability of answering 429.")
+    parser.add_argument('--chars_per_token', type=float, default=3.0, help="Used to decide whether a prompt exceeds the context window.")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def config_from_args(args):
+    return StubConfig(latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                      latency_per_token=args.latency_per_token, rate_limit_prob=args.rate_limit_prob,
+                      chars_per_token=args.chars_per_token, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    add_stub_args(parser)
+    args = parser.parse_args()
+    server = make_server(config_from_args(args), args.port)
+    print(f"Serving on http://127.0.0.1:{server.server_address[1]}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
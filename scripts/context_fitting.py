@@ -0,0 +1,76 @@
+# Shared helper for fitting prompts into a model's context window.
+# Replaces the descending `for max_tokens in range(...)` retry loops: the largest truncation level
+# that fits is found by binary search over a local length estimate, so only a handful of requests
+# (usually one) go out per input.
+from collections import namedtuple
+
+# Context window sizes (in model tokens) of the models used by the scripts.
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+}
+
+# Conservative estimate of characters per model token for English news text.
+CHARS_PER_TOKEN = 3.5
+# Formatting overhead the chat API adds for every message.
+TOKENS_PER_MESSAGE = 4
+
+FitResult = namedtuple('FitResult', ['response', 'value', 'probes', 'estimated_tokens'])
+
+
+# Estimate the number of model tokens of a chat prompt without tokenizing it.
+def estimate_prompt_tokens(messages):
+    num_chars = sum(len(message['content']) for message in messages)
+    return int(num_chars / CHARS_PER_TOKEN) + TOKENS_PER_MESSAGE * len(messages)
+
+
+# Number of prompt tokens available for a model, leaving room for the completion.
+def prompt_budget(model, completion_tokens=1024):
+    return CONTEXT_WINDOWS[model] - completion_tokens
+
+
+# Find the largest value in [low, high] whose prompt is estimated to fit the budget.
+# `build_prompt` must produce prompts that grow monotonically with the value.
+def largest_fitting_value(build_prompt, budget, low, high, estimate=estimate_prompt_tokens):
+    prompt = build_prompt(high)
+    if estimate(prompt) <= budget:
+        return high, prompt
+    best_value, best_prompt = low, None
+    while low <= high:
+        mid = (low + high) // 2
+        mid_prompt = build_prompt(mid)
+        if estimate(mid_prompt) <= budget:
+            best_value, best_prompt = mid, mid_prompt
+            low = mid + 1
+        else:
+            high = mid - 1
+    if best_prompt is None:
+        best_prompt = build_prompt(best_value)
+    return best_value, best_prompt
+
+
+# Send the largest prompt that fits the context window.
+# `build_prompt(value)` builds the prompt at a given truncation level (e.g. max_tokens) and
+# `request(prompt)` returns the completion or None when the prompt was rejected. Whenever a
+# request is rejected, the budget is shrunk by `shrink` and the search is repeated, up to
+# `max_probes` requests in total. The search is recorded as a 'fit' event if `metrics` is given.
+def fit_to_context(build_prompt, request, budget, high, low=1, shrink=0.85, max_probes=6,
+                   estimate=estimate_prompt_tokens, metrics=None):
+    response, value, probes, estimated_tokens = None, high, 0, 0
+    original_high = high
+    while probes < max_probes:
+        value, prompt = largest_fitting_value(build_prompt, budget, low, high, estimate=estimate)
+        estimated_tokens = estimate(prompt)
+        probes += 1
+        response = request(prompt)
+        if response is not None or value <= low:
+            break
+        # The estimate was too optimistic for this input; retry with a smaller budget.
+        budget = min(int(budget * shrink), int(estimated_tokens * shrink))
+        high = value - 1
+    if metrics is not None:
+        metrics.record('fit', value=value, probes=probes, estimated_tokens=estimated_tokens,
+                       truncated=int(value < original_high), failed=int(response is None))
+    return FitResult(response, value, probes, estimated_tokens)
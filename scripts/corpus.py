@@ -0,0 +1,183 @@
+# Streaming access to the article / event / question corpora.
+# iter_records yields the records of a JSON array or JSONL file one at a time without loading the
+# file, and ArticleIndex keeps only an id -> byte offset map (persisted in a sidecar file) so that
+# articles are read from disk on demand. GroupedIndex does the same for records grouped by a field
+# (e.g. questions by event_id). Memory use therefore stays flat as the corpus grows.
+import json
+import os
+import re
+import threading
+from jsonl_io import compression_of, open_compressed_reader
+
+CHUNK_SIZE = 1 << 20
+INDEX_VERSION = 1
+
+# Bytes that matter when scanning for record boundaries in a JSON array.
+STRUCTURAL_BYTES = re.compile(rb'["\\{}\[\]]')
+
+
+def is_jsonl(path):
+    return re.search(r'\.jsonl(\.gz|\.zst)?$', path) is not None
+
+
+# Yield (offset, raw bytes) of every record in a JSONL file.
+def iter_jsonl_spans(f):
+    offset = 0
+    for line in f:
+        if line.strip():
+            yield offset, line
+        offset += len(line)
+
+
+# Yield (offset, raw bytes) of every object or array directly inside a top-level JSON array.
+def iter_json_array_spans(f):
+    depth = 0
+    in_string = False
+    skip_until = 0
+    buffer = b''
+    buffer_start = 0
+    record_start = None
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        chunk_start = buffer_start + len(buffer)
+        buffer += chunk
+        for match in STRUCTURAL_BYTES.finditer(chunk):
+            position = chunk_start + match.start()
+            if position < skip_until:
+                continue
+            byte = match.group()
+            if in_string:
+                if byte == b'\\':
+                    skip_until = position + 2
+                elif byte == b'"':
+                    in_string = False
+            elif byte == b'"':
+                in_string = True
+            elif byte in (b'{', b'['):
+                if depth == 1:
+                    record_start = position
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 1 and record_start is not None:
+                    yield record_start, buffer[record_start - buffer_start:position + 1 - buffer_start]
+                    record_start = None
+        # Only keep the bytes of the record being scanned.
+        keep_from = record_start if record_start is not None else buffer_start + len(buffer)
+        buffer = buffer[keep_from - buffer_start:]
+        buffer_start = keep_from
+
+
+def iter_record_spans(path):
+    with open(path, 'rb') as f:
+        spans = iter_jsonl_spans(f) if is_jsonl(path) else iter_json_array_spans(f)
+        for offset, raw in spans:
+            yield offset, raw
+
+
+# Lazily yield the records of a JSON array or JSONL (optionally .gz/.zst compressed) file.
+def iter_records(path):
+    if compression_of(path):
+        with open_compressed_reader(path) as f:
+            for _, raw in iter_jsonl_spans(f):
+                yield json.loads(raw)
+        return
+    for _, raw in iter_record_spans(path):
+        yield json.loads(raw)
+
+
+def index_path_for(path):
+    return os.path.splitext(path)[0] + '.offsets.json'
+
+
+# Load a sidecar index, rebuilding it with build_offsets() if the corpus changed since it was written.
+def load_or_build_offsets(path, index_path, key, build_offsets):
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime, 'key': key, 'version': INDEX_VERSION}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('source') == signature:
+            return cached['offsets']
+    offsets = build_offsets()
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': signature, 'offsets': offsets}, f)
+    os.replace(tmp_path, index_path)
+    return offsets
+
+
+class OffsetReader:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.lock = threading.Lock()
+
+    def read(self, offset, length):
+        if hasattr(os, 'pread'):
+            raw = os.pread(self.fd, length, offset)
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                raw = os.read(self.fd, length)
+        return json.loads(raw)
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Read-only mapping from record id to record, backed by byte offsets into the corpus file.
+class ArticleIndex(OffsetReader):
+    def __init__(self, path, key="_id", index_path=None):
+        super().__init__(path)
+        self.key = key
+        self.index_path = index_path or index_path_for(path)
+        self.offsets = load_or_build_offsets(path, self.index_path, key, self.build_offsets)
+
+    def build_offsets(self):
+        offsets = {}
+        for offset, raw in iter_record_spans(self.path):
+            offsets[str(json.loads(raw)[self.key])] = [offset, len(raw)]
+        return offsets
+
+    # Ids are compared as strings, the form they take in the persisted index.
+    def __contains__(self, record_id):
+        return str(record_id) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, record_id):
+        return self.read(*self.offsets[str(record_id)])
+
+    def get(self, record_id, default=None):
+        if record_id not in self:
+            return default
+        return self[record_id]
+
+
+# Read-only mapping from a group id (e.g. event_id) to the list of records in that group, in file order.
+# Built in one pass over the corpus and persisted like ArticleIndex.
+class GroupedIndex(OffsetReader):
+    def __init__(self, path, key, index_path=None):
+        super().__init__(path)
+        self.key = key
+        self.index_path = index_path or os.path.splitext(path)[0] + '.by_%s.json' % key
+        self.offsets = load_or_build_offsets(path, self.index_path, key, self.build_offsets)
+
+    def build_offsets(self):
+        offsets = {}
+        for offset, raw in iter_record_spans(self.path):
+            offsets.setdefault(str(json.loads(raw)[self.key]), []).append([offset, len(raw)])
+        return offsets
+
+    def __contains__(self, group_id):
+        return str(group_id) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, group_id):
+        return [self.read(offset, length) for offset, length in self.offsets[str(group_id)]]
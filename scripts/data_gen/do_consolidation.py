@@ -1,78 +1,419 @@
 # adapted from https://github.com/salesforce/discord_questions/blob/d7cbd514895bdfbb54782645909eea70fe1435b3/dq_pipeline.py
-import json
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from tqdm import tqdm
 import argparse
-from model_consolidation import ConsolidationModel
+from model_consolidation import ConsolidationModel, consolidate_from_scores
+from score_cache import ScoreCache
+from score_store import ScoreStore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from jsonl_io import JsonlWriter, compression_of, count_jsonl_output, read_jsonl_output
+from metrics import Metrics
+from corpus import GroupedIndex, iter_records
+
+# Model and grouping options, shared with run_pipeline.py
+def add_consolidation_args(parser):
+    parser.add_argument('--prefilter', type=str, default=None, choices=['tfidf', 'jaccard'], help="Lexical pre-filter that skips dissimilar answer pairs.")
+    parser.add_argument('--prefilter_floor', type=float, default=0.05, help="Pairs less similar than this are not scored by the model.")
+    parser.add_argument('--thresh', type=float, default=2.75, help="Score above which two answers are linked.")
+    parser.add_argument('--community_backend', type=str, default='louvain', choices=['louvain', 'igraph'], help="Community detection for graphs that are not disjoint cliques; 'igraph' needs python-igraph.")
+    parser.add_argument('--score_store', type=str, default=None, help="Directory to save the raw score matrices in, for rethreshold.py.")
+    parser.add_argument('--score_cache_path', type=str, default="consolidation_scores.sqlite", help="Pair score cache file. Pass '' to disable.")
+    parser.add_argument('--device', type=str, default='cuda', help="'cuda' or 'cpu'.")
+    parser.add_argument('--quantize', action='store_true', help="Dynamic int8 quantization of the model (CPU only).")
+    parser.add_argument('--num_threads', type=int, default=None, help="Torch threads on CPU (default: torch's own, or the available CPUs split between workers).")
+    parser.add_argument('--batch_pairs', type=int, default=4096, help="Answer pairs collected across questions and events before running the model.")
+    parser.add_argument('--num_workers', type=int, default=1, help="Worker processes, each with its own model; output order is unchanged.")
 
 # Setup argument parser
 parser = argparse.ArgumentParser()
 parser.add_argument('--generated_question_path', type=str, required=True, help="The file produced by gpt_qg.py.")
 parser.add_argument('--generated_answer_path', type=str, required=True, help="The file produced by gpt_qa.py.")
 parser.add_argument('--output_path', type=str, required=True)
-args = parser.parse_args()
-
-# Initialize the consolidation model
-model = ConsolidationModel(model_card='Salesforce/qa_consolidation')
-
-# Function to load data from JSON or JSONL files
-def load_json(filepath):
-    with open(filepath, "r") as f:
-        if filepath.endswith('jsonl'):
-            return [json.loads(line) for line in f.readlines()]
-        else:
-            return json.load(f)
-
-# Load all necessary data
-questions = load_json("PATH/TO/QUESTIONS.json")
-events = load_json("PATH/TO/EVENTS.json")
-articles = load_json("PATH/TO/ARTICLES.json")
-questions_with_events = load_json(args.generated_question_path)
-generated_answers = load_json(args.generated_answer_path)
-
-# Create lookup dictionaries
-aid2article = {a["_id"]: a for a in articles}
-eid2event = {e["eid"]: e for e in questions_with_events}
-
-# Function to consolidate answers for a single question-event pair
-def consolidate_answers(event, generated_answers, model):
-    answers_for_all_questions = []
-    this_generated_questions = event['questions']
-    
-    assert len(generated_answers) == len(this_generated_questions), (len(generated_answers), len(this_generated_questions))
+parser.add_argument('--metrics_path', type=str, default=None, help="JSONL trace of every model batch; workers write <path>.<pid>.")
+add_consolidation_args(parser)
+
+# Set by setup(), from the command line, in each worker process or by run_pipeline.py
+args = None
+
+def setup(parsed_args):
+    global args
+    args = parsed_args
+
+MODEL_CARD = 'Salesforce/qa_consolidation'
+
+# Set by load_model, in the main process or in each worker process
+model = None
+score_cache = None
+metrics = None
+
+def load_model(num_threads=None, worker=False):
+    global model, score_cache, metrics
+    metrics_path = args.metrics_path
+    if worker and metrics_path:
+        root, ext = os.path.splitext(metrics_path)
+        metrics_path = f"{root}.{os.getpid()}{ext}"
+    metrics = Metrics(metrics_path)
+    if worker:
+        # Flush the worker's trace when the pool shuts it down.
+        multiprocessing.util.Finalize(metrics, metrics.close, exitpriority=10)
+    # Quantized scores differ slightly from fp32 ones, so they are cached separately.
+    model_id = MODEL_CARD + ('@int8' if args.quantize else '')
+    score_cache = ScoreCache(args.score_cache_path, model_id=model_id) if args.score_cache_path else None
+    model = ConsolidationModel(model_card=MODEL_CARD, device=args.device, score_cache=score_cache,
+                               prefilter=args.prefilter, prefilter_floor=args.prefilter_floor,
+                               quantize=args.quantize, num_threads=num_threads, metrics=metrics)
+
+# Pool initializer: spawned workers do not parse the command line.
+def init_worker(parsed_args, num_threads):
+    setup(parsed_args)
+    load_model(num_threads, worker=True)
+
+ANSWER_HEADER = re.compile(r'\s*\bAnswer \d+\s*:\s*', re.IGNORECASE)
+# 'No Answer', 'No answer found.', '[No Answer]', ...
+NO_ANSWER = re.compile(r'^\W*no answer\b', re.IGNORECASE)
+
+# The answers of one article: a list, or the raw 'Answer 1: ... Answer 2: ...' / 'No Answer' response
+# that gpt_qa.py records (None if the call failed). Text before the first header (e.g. 'Here are the
+# answers:') is dropped, and so are 'No Answer' blocks.
+def parse_answers(answers):
+    if answers is None:
+        return []
+    if not isinstance(answers, str):
+        return answers
+    blocks = ANSWER_HEADER.split(answers)
+    if len(blocks) > 1:
+        blocks = blocks[1:]
+    blocks = [block.strip() for block in blocks]
+    return [block for block in blocks if block and not NO_ANSWER.match(block)]
+
+# The answers of a gpt_qa.py record as the paragraphs the model consolidates, with the article they come from
+def record_paragraphs(aids, articles_answers):
+    return [{'answer': answer, 'aid': aid} for aid, answers in zip(aids, articles_answers) for answer in parse_answers(answers)]
+
+# The (question, paragraphs) items of one event, one per generated question
+def event_paragraphs(event, generated_answers):
+    items = []
+    this_generated_questions = event['questions'] or []
+
+    # Answer records are matched to the questions by text. A question answered again (after a failed call)
+    # has a later record, which is the one used.
+    question2answers = {}
+    for articles_answers in generated_answers:
+        question2answers[articles_answers['question']] = articles_answers
+    missing = [question for question in this_generated_questions if question not in question2answers]
+    assert not missing, missing
     
-    for question, articles_answers in zip(this_generated_questions, generated_answers):
-        assert question == articles_answers['question']
+    for question in this_generated_questions:
+        articles_answers = question2answers[question]
         aids = articles_answers['aids']
         articles_answers = articles_answers['answers']
         
         assert len(articles_answers) == len(aids), (len(articles_answers), len(aids))
         
-        valid_articles = []
-        for aid, answers in zip(aids, articles_answers):
-            for answer in answers:
-                valid_articles.append({'answer': answer, 'aid': aid})
-        
+        items.append((question, record_paragraphs(aids, articles_answers)))
+    return items
+
+# Upper bound on the answer pairs of an event; deduplication, the pre-filter and the cache only lower it.
+def pair_bound(event_items):
+    return sum(len(paragraphs) * (len(paragraphs) - 1) for _, paragraphs in event_items)
+
+# Batches of (event, items), cut once about args.batch_pairs answer pairs are pending
+def event_batches(pairs):
+    batch, batch_pairs = [], 0
+    for event, this_generated_answers in pairs:
+        event_items = event_paragraphs(event, this_generated_answers)
+        batch.append((event, event_items))
+        batch_pairs += pair_bound(event_items)
+        if batch_pairs >= args.batch_pairs:
+            yield batch
+            batch, batch_pairs = [], 0
+    if batch:
+        yield batch
+
+# Score matrices of all questions of a batch of events. The answer pairs of all questions are scored
+# in shared model batches; None marks a question that could not be scored.
+def score_events(batch):
+    items = [item for _, event_items in batch for item in event_items]
+    before = dict(model.stats)
+    try:
+        return model.score_matrices(items)
+    except Exception as e:
+        print(f"Error scoring answer pairs, falling back to one question at a time: {e}")
+    # The pairs counted by the failed attempt are counted again by the fallback.
+    model.stats.update(before)
+    weight_matrices = []
+    for question, valid_articles in items:
         try:
-            answer_groups = model.consolidate(question=question, paragraphs=valid_articles)
+            weight_matrices.append(model.score_matrix(question, valid_articles))
         except Exception as e:
             print(f"Error consolidating answers: {e}")
-            answer_groups = []
-        
-        result = {
-            'eid': event['eid'],
-            'question': question,
-            'answer_groups': answer_groups
-        }
-        answers_for_all_questions.append(result)
+            weight_matrices.append(None)
+    return weight_matrices
+
+# Stands in for the results of an event with a question that could not be scored or grouped.
+class FailedEvent:
+    def __init__(self, eid):
+        self.eid = eid
+
+# Build each question's graph from its score matrix. Returns one result list per event, or a FailedEvent,
+# so that the event is not recorded as consolidated.
+def group_events(batch, weight_matrices):
+    results = []
+    item_idx = 0
+    for event, event_items in batch:
+        answers_for_all_questions = []
+        for question, valid_articles in event_items:
+            weight_matrix = weight_matrices[item_idx]
+            item_idx += 1
+            if answers_for_all_questions is None or weight_matrix is None:
+                answers_for_all_questions = None
+                continue
+            try:
+                answer_groups = consolidate_from_scores(weight_matrix, valid_articles, args.thresh, backend=args.community_backend)
+            except Exception as e:
+                print(f"Error consolidating answers: {e}")
+                answers_for_all_questions = None
+                continue
+            
+            result = {
+                'eid': event['eid'],
+                'question': question,
+                'answer_groups': answer_groups
+            }
+            answers_for_all_questions.append(result)
+        if answers_for_all_questions is None:
+            print(f"Event {event['eid']} could not be consolidated")
+            answers_for_all_questions = FailedEvent(event['eid'])
+        results.append(answers_for_all_questions)
     
-    return answers_for_all_questions
+    return results
+
+# (eid, question, paragraphs, score matrix) of the scored questions of a batch, for the score store
+def matrices_to_store(batch, weight_matrices):
+    if not args.score_store:
+        return None
+    items = [(event['eid'], question, valid_articles) for event, event_items in batch for question, valid_articles in event_items]
+    return [item + (weight_matrix,) for item, weight_matrix in zip(items, weight_matrices) if weight_matrix is not None]
+
+# Worker task: consolidate one batch, returning the results, the matrices to store (the score store is
+# only written by the main process), the model's stats and the metrics totals for this batch.
+def consolidate_batch(batch):
+    before = dict(model.stats)
+    weight_matrices = score_events(batch)
+    results = group_events(batch, weight_matrices)
+    stats = {key: model.stats[key] - before[key] for key in before}
+    return results, matrices_to_store(batch, weight_matrices), stats, metrics.take_totals()
+
+# One process: building the graphs of a batch (in a thread) overlaps with scoring the next one.
+def run_in_process(batches):
+    if model is None:
+        load_model(args.num_threads)
+    with ThreadPoolExecutor(max_workers=1) as grouper:
+        pending = None
+        for batch in batches:
+            before = dict(model.stats)
+            weight_matrices = score_events(batch)
+            stats = {key: model.stats[key] - before[key] for key in before}
+            if pending is not None:
+                yield pending.result()
+            pending = grouper.submit(lambda b, w, s: (group_events(b, w), matrices_to_store(b, w), s, None),
+                                     batch, weight_matrices, stats)
+        if pending is not None:
+            yield pending.result()
+    if score_cache is not None:
+        score_cache.close()
+
+# CPUs this process may run on: the affinity mask (taskset, cgroup cpusets) rather than every core of the machine.
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Batches are spread over worker processes and their results come back in input order. At most two
+# batches per worker are in flight, so events are not all read into memory ahead of the workers.
+def run_sharded(batches):
+    global metrics
+    # Totals of the workers are merged here; their records go to their own trace files.
+    metrics = Metrics()
+    num_threads = args.num_threads or max(1, available_cpus() // args.num_workers)
+    slots = threading.BoundedSemaphore(2 * args.num_workers)
+
+    def throttled():
+        for batch in batches:
+            slots.acquire()
+            yield batch
+
+    # spawn rather than fork, so that workers can use CUDA.
+    with multiprocessing.get_context('spawn').Pool(args.num_workers, initializer=init_worker, initargs=(args, num_threads)) as pool:
+        for output in pool.imap(consolidate_batch, throttled()):
+            slots.release()
+            yield output
+        pool.close()
+        pool.join()
+
+# Answer records of gpt_qa.py grouped by event id, read from disk on demand (in memory if compressed).
+def answers_by_eid(path):
+    if compression_of(path):
+        grouped = {}
+        for record in iter_records(path):
+            grouped.setdefault(record['eid'], []).append(record)
+        return grouped
+    return GroupedIndex(path, key='eid')
+
+# (event, answer records) in the order of the question file. gpt_qa.py writes one record per question
+# in the order they finish, so the records are looked up by eid; files with one list of records per
+# event (without eids) are still paired line by line. Stops at the first event whose questions are not
+# all answered yet, so that output lines stay aligned with the question file.
+def event_answers(events, answer_path):
+    answer_records = iter_records(answer_path)
+    first = next(answer_records, None)
+    if first is None or isinstance(first, list):
+        yield from zip(events, chain([first], answer_records) if first is not None else [])
+        return
+    answer_records.close()
+    answers = answers_by_eid(answer_path)
+    try:
+        for event in events:
+            records = answers[event['eid']] if event['eid'] in answers else []
+            answered = {record['question'] for record in records}
+            missing = [question for question in event['questions'] or [] if question not in answered]
+            if missing:
+                tqdm.write(f"Stopping at event {event['eid']}: {len(missing)} of its questions are not answered in {answer_path} yet")
+                return
+            yield event, records
+    finally:
+        if isinstance(answers, GroupedIndex):
+            answers.close()
+
+# Write the consolidated events coming back from run_in_process or run_sharded, in order. Returns the
+# summed model stats. With skip_failed, FailedEvents are left out (for callers that resume by eid);
+# otherwise they are passed on to the writer (an OutputLines).
+def write_outputs(outputs, writer, score_store, progress, skip_failed=False):
+    stats = {"pairs": 0, "pairs_after_dedup": 0, "pairs_pruned": 0, "pairs_scored": 0, "cache_hits": 0}
+    start = time.perf_counter()
+    for results, stored, batch_stats, worker_metrics in outputs:
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        if score_store is not None:
+            for eid, question, valid_articles, weight_matrix in stored:
+                score_store.put(eid, question, valid_articles, weight_matrix)
+        if skip_failed:
+            results = [event_results for event_results in results if not isinstance(event_results, FailedEvent)]
+        writer.write_many(results)
+        for key, value in batch_stats.items():
+            stats[key] += value
+        progress.update(len(results))
+        progress.set_postfix(pairs_per_sec=f"{stats['pairs_scored'] / max(time.perf_counter() - start, 1e-9):.0f}")
+    return stats
+
+def print_stats(stats, elapsed):
+    print(f"Answer pairs: {stats['pairs']}, after deduplication: {stats['pairs_after_dedup']} "
+          f"({stats['pairs'] - stats['pairs_after_dedup']} skipped), pruned by the lexical pre-filter: {stats['pairs_pruned']}, "
+          f"score cache hits: {stats['cache_hits']}, "
+          f"scored by the model: {stats['pairs_scored']}")
+    print(f"Consolidation time: {elapsed:.1f}s, {stats['pairs_scored'] / max(elapsed, 1e-9):.1f} pairs/sec")
+    if args.score_cache_path:
+        # Every candidate pair left after deduplication and the pre-filter is looked up in the cache.
+        lookups = stats['pairs_after_dedup'] - stats['pairs_pruned']
+        print(f"Score cache hit rate: {stats['cache_hits'] / lookups if lookups else 0.0:.1%}")
+
+# Events that could not be consolidated, as {'eid', 'line'} records: their output line is written as an
+# empty list and the next run consolidates them again, e.g. consolidated.jsonl -> consolidated.failed.jsonl
+def failed_path_for(output_path):
+    return os.path.splitext(output_path)[0] + '.failed.jsonl'
+
+# Output lines of the consolidated events, in event order: the first len(retry_lines) events replace the
+# lines of events that failed in an earlier run (applied by replace_lines once the run is done), the others
+# are appended. Events that fail are logged in failed_log and written as an empty list.
+class OutputLines:
+    def __init__(self, writer, failed_log, next_line, retry_lines):
+        self.writer = writer
+        self.failed_log = failed_log
+        self.next_line = next_line
+        self.first_appended = next_line
+        self.retry_lines = list(retry_lines)
+        self.replacements = {}
+        self.failed = []
+
+    def write_many(self, results):
+        for event_results in results:
+            if self.retry_lines:
+                line = self.retry_lines.pop(0)
+            else:
+                line = self.next_line
+                self.next_line += 1
+            if isinstance(event_results, FailedEvent):
+                self.failed.append({'eid': event_results.eid, 'line': line})
+                self.failed_log.write(self.failed[-1])
+                event_results = []
+            if line < self.first_appended:
+                self.replacements[line] = event_results
+            else:
+                self.writer.write(event_results)
+
+# The records of a file at the given line numbers, in file order.
+def records_at_lines(path, lines):
+    lines = set(lines)
+    return (record for line, record in enumerate(iter_records(path)) if line in lines)
+
+# Rewrite an output file with some of its lines replaced, e.g. by events consolidated again.
+def replace_lines(path, replacements):
+    tmp_path = path + '.tmp' + os.path.splitext(path)[1]
+    with JsonlWriter(tmp_path, append=False) as writer:
+        for line, record in enumerate(read_jsonl_output(path)):
+            writer.write(replacements.get(line, record))
+    os.replace(tmp_path, path)
 
 # Main processing loop
 def main():
-    for event, this_generated_answers in tqdm(zip(questions_with_events, generated_answers), total=len(generated_answers)):
-        answers_for_all_questions = consolidate_answers(event, this_generated_answers, model)
-        with open(args.output_path, 'a') as f:
-            f.write(json.dumps(answers_for_all_questions) + '\n')
+    # Events are written in input order (one line each, possibly an empty list), so the number of
+    # complete lines in the output tells how many events a previous run already consolidated.
+    num_completed = count_jsonl_output(args.output_path)
+    # Events that failed in an earlier run are consolidated again first.
+    failed_path = failed_path_for(args.output_path)
+    retry_lines = sorted({record['line'] for record in read_jsonl_output(failed_path) if record['line'] < num_completed})
+    questions_with_events = chain(records_at_lines(args.generated_question_path, retry_lines),
+                                  islice(iter_records(args.generated_question_path), num_completed, None))
+    pairs = event_answers(questions_with_events, args.generated_answer_path)
+    batches = event_batches(pairs)
+    # The model (or the worker pool) is only loaded once there is an event left to consolidate.
+    first_batch = next(batches, None)
+    if first_batch is None:
+        print(f"Nothing to consolidate: all {num_completed} events are already in {args.output_path}")
+        return
+    batches = chain([first_batch], batches)
+    score_store = ScoreStore(args.score_store) if args.score_store else None
+    outputs = run_sharded(batches) if args.num_workers > 1 else run_in_process(batches)
+
+    start = time.perf_counter()
+    with JsonlWriter(args.output_path) as writer, JsonlWriter(failed_path) as failed_log:
+        output_lines = OutputLines(writer, failed_log, num_completed, retry_lines)
+        progress = tqdm(initial=num_completed - len(retry_lines))
+        stats = write_outputs(outputs, output_lines, score_store, progress)
+        progress.close()
+    if output_lines.replacements:
+        replace_lines(args.output_path, output_lines.replacements)
+    # The log keeps the events that failed in this run, including the retried ones that failed again.
+    if not output_lines.failed:
+        os.remove(failed_path)
+    else:
+        with JsonlWriter(failed_path + '.tmp', append=False) as failed_log:
+            failed_log.write_many(output_lines.failed)
+        os.replace(failed_path + '.tmp', failed_path)
+        print(f"{len(output_lines.failed)} events could not be consolidated and are written as empty lists; "
+              f"they are listed in {failed_path} and retried by the next run")
+    print_stats(stats, time.perf_counter() - start)
+    print(metrics.summary())
+    metrics.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    setup(parser.parse_args())
+    main()
@@ -1,43 +1,53 @@
 import openai
-import backoff
-from openai.error import RateLimitError
-import json
 import os
-import pandas as pd
+import re
+import sys
 from tqdm import tqdm
-from nltk import word_tokenize
 import argparse
-import nltk
 from concurrent.futures import ThreadPoolExecutor
 
-nltk.download('punkt')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from context_fitting import estimate_prompt_tokens, fit_to_context, prompt_budget
+from token_cache import TokenCache, cache_path_for
+from llm_client import LLMClient, add_client_args
+from jsonl_io import JsonlWriter, completed_keys
+from corpus import ArticleIndex, iter_records
+from nltk_resources import ensure_punkt
+from lexical_filter import article_relevance
 
-# Set the OpenAI API key from environment variables
-openai.api_key = os.environ["OPENAI_API_KEY"]
+MODEL_NAME = "gpt-3.5-turbo-16k"
 
 # Parser for command-line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--generated_question_path', type=str, required=True, help="The file produced by gpt_qg.py.")
-parser.add_argument('--output_path', type=str, required=True)
-args = parser.parse_args()
-
-# Exponential backoff for handling Rate Limit errors from OpenAI API
-@backoff.on_exception(backoff.expo, RateLimitError)
-def response_API(prompt):
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=prompt
-        )   
-        return response['choices'][0]['message']['content']
-    except (openai.error.APIConnectionError, openai.error.InvalidRequestError) as e:
-        print(f"API call failed: {e}")
-        return None
+parser.add_argument('--articles_path', type=str, default="PATH/TO/ARTICLES.json")
+parser.add_argument('--output_path', type=str, required=True, help="Output jsonl file. Add a .gz or .zst suffix to compress it.")
+parser.add_argument('--questions_per_call', type=int, default=1, help="Number of questions answered per API call. Batches that do not fit the context window are split.")
+parser.add_argument('--relevance_cutoff', type=float, default=None, help="Record 'No Answer' without a call for articles whose BM25 relevance to the question, relative to the event's most relevant article, is below this (e.g. 0.1). See benchmarks/bench_relevance_filter.py.")
+add_client_args(parser)
+
+# Set by setup(), from the command line or by run_pipeline.py (which shares its client and token cache with gpt_qg.py)
+args = None
+client = None
+token_cache = None
+
+def setup(parsed_args, shared_client=None, shared_token_cache=None):
+    global args, client, token_cache
+    args = parsed_args
+    ensure_punkt()
+
+    # Set the OpenAI API key from environment variables
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    client = shared_client or LLMClient.from_args(MODEL_NAME, args)
+
+    # Token offsets of every article, computed once and reused across runs.
+    token_cache = shared_token_cache or TokenCache(cache_path_for(args.articles_path))
+
 
 # Function to format the prompt for the OpenAI API
 def format_prompt(article, question, max_token=6000):
-    if len(word_tokenize(article)) > max_token:
-        article = ' '.join(word_tokenize(article)[:max_token])
+    article = token_cache.truncate(article, max_token)
         
     messages = [
         {"role": "user", "content": (
@@ -50,39 +60,105 @@ def format_prompt(article, question, max_token=6000):
     ]
     return messages
 
-# Function to load data from JSON or JSONL files
-def load_json(filepath):
-    with open(filepath, "r") as f:
-        if filepath.endswith('jsonl'):
-            return [json.loads(line) for line in f.readlines()]
-        else:
-            return json.load(f)
+# Function to format a prompt that answers several questions about one article
+def format_batch_prompt(article, questions, max_token=6000):
+    article = token_cache.truncate(article, max_token)
+    questions_string = "\n".join(f"Question {idx + 1}: {question}" for idx, question in enumerate(questions))
+
+    messages = [
+        {"role": "user", "content": (
+            "Read the following news article and answer each of the questions below. "
+            "For each question, extract the exact sentence from the article changing up to 5 words. You should include ALL the answers that can be found in the article. "
+            "Repeat the question header before its answers and give your answers in a structured format: "
+            "'Question 1: \n Answer 1: [extracted answer 1] \n Answer 2: [extracted answer 2] ... \n Question 2: \n Answer 1: [extracted answer 1] ...'. "
+            "If the article contains no information to a question, write 'No Answer' under its header."
+            "==========="
+            f"{questions_string}"
+            "==========="
+            f"{article}"
+        )}
+    ]
+    return messages
+
+# Recorded for the articles skipped by the relevance filter, as the model answers when it finds nothing.
+NO_ANSWER = 'No Answer'
+
+# Mask of the articles to skip for each question (n_questions x n_articles), None without --relevance_cutoff.
+# All questions of an event are scored against all its articles at once.
+def irrelevant_articles(questions, articles):
+    if args.relevance_cutoff is None:
+        return None
+    return article_relevance(questions, articles) < args.relevance_cutoff
+
+def record_skipped(skip):
+    if skip is not None:
+        client.metrics.record('relevance_filter', skipped=int(skip.sum()), sent=int(skip.size - skip.sum()))
+
+# Split a batched response into one answer block per question, in the single-question response format.
+# Questions missing from the response, or with nothing under their header, are returned as None.
+def parse_batch_response(response, num_questions):
+    blocks = [None] * num_questions
+    parts = re.split(r'^\s*Question (\d+)\s*:([^\n]*)$', response, flags=re.MULTILINE)
+    for number, header_rest, block in zip(parts[1::3], parts[2::3], parts[3::3]):
+        idx = int(number) - 1
+        # The rest of the header line may hold the first answer, after the echoed question or on its own
+        # (e.g. 'Question 1: Who won? Answer 1: Biden won.').
+        first_answer = re.search(r'Answer \d+\s*:|No Answer', header_rest, flags=re.IGNORECASE)
+        if first_answer is not None:
+            block = header_rest[first_answer.start():] + block
+        if 0 <= idx < num_questions and blocks[idx] is None:
+            blocks[idx] = block.strip() or None
+    return blocks
 
 def main():
-    questions_with_events = load_json(args.generated_question_path)
-    articles = load_json("PATH/TO/ARTICLES.json")
-    aid2article = {a["_id"]: a for a in articles}
-    
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    # Articles are read from disk by id instead of being held in memory.
+    aid2article = ArticleIndex(args.articles_path)
+
+    # Skip the (event, question) pairs already answered by a previous run; questions with an article whose
+    # call failed are asked again.
+    completed = completed_keys(args.output_path, lambda record: (record['eid'], record['question']) if None not in record['answers'] else None)
+
+    # The writer is closed (flushing what is queued) even if a task fails.
+    with JsonlWriter(args.output_path) as writer, ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
         futures = []
-        for event in tqdm(questions_with_events):
+        for event in tqdm(iter_records(args.generated_question_path)):
             eid = event['eid']
             aids = event['aids']
-            questions = event['questions']
+            questions = [question for question in event['questions'] or [] if (eid, question) not in completed]
+            if not questions:
+                continue
             articles_content = [aid2article[aid]['content'] for aid in aids]
+            skip = irrelevant_articles(questions, articles_content)
+
+            if args.questions_per_call > 1:
+                futures.append(executor.submit(process_event_batched, eid, aids, questions, articles_content, writer, args.questions_per_call, skip))
+            else:
+                for idx, question in enumerate(questions):
+                    futures.append(executor.submit(process_question, eid, aids, question, articles_content, writer,
+                                                   None if skip is None else skip[idx]))
+
+            # Bound the number of queued tasks so only a window of articles is held in memory.
+            while len(futures) > args.max_concurrency * 4:
+                futures.pop(0).result()
 
-            for question in questions:
-                futures.append(executor.submit(process_question, eid, aids, question, articles_content, args.output_path))
-        
         for future in futures:
             future.result()
 
-def process_question(eid, aids, question, articles, output_path):
+    aid2article.close()
+    token_cache.save()
+    client.close()
+
+# `skip` optionally masks the articles to record as 'No Answer' without a call.
+def process_question(eid, aids, question, articles, writer, skip=None):
     all_answers = []
-    for article in articles:
-        prompt = format_prompt(article=article, question=question)
-        answers = response_API_with_retry(prompt, article, question)
-        all_answers.append(answers)
+    with client.metrics.labels(stage='qa', eid=eid):
+        for idx, article in enumerate(articles):
+            if skip is not None and skip[idx]:
+                all_answers.append(NO_ANSWER)
+                continue
+            answers = response_API_with_retry(article, question)
+            all_answers.append(answers)
+        record_skipped(skip)
 
     answers_for_this_question = {
         'eid': eid,
@@ -91,18 +167,62 @@ def process_question(eid, aids, question, articles, output_path):
         'answers': all_answers
     }
 
-    with open(output_path, 'a') as f:
-        f.write(json.dumps(answers_for_this_question) + '\n')
+    writer.write(answers_for_this_question)
+    return answers_for_this_question
+
+# Answer all questions of an event, sending each article once per batch of questions.
+# Writes (and returns) the same per-question records as process_question. `skip` optionally masks the
+# (question, article) pairs to record as 'No Answer' without asking.
+def process_event_batched(eid, aids, questions, articles, writer, questions_per_call, skip=None):
+    all_answers = [[] for _ in questions]
+    with client.metrics.labels(stage='qa', eid=eid):
+        for article_idx, article in enumerate(articles):
+            asked = [idx for idx in range(len(questions)) if skip is None or not skip[idx, article_idx]]
+            article_answers = [NO_ANSWER] * len(questions)
+            for start in range(0, len(asked), questions_per_call):
+                batch = asked[start:start + questions_per_call]
+                for idx, answers in zip(batch, answer_batch(article, [questions[idx] for idx in batch])):
+                    article_answers[idx] = answers
+            for question_answers, answers in zip(all_answers, article_answers):
+                question_answers.append(answers)
+        record_skipped(skip)
+
+    records = [{
+        'eid': eid,
+        'aids': aids,
+        'question': question,
+        'answers': question_answers
+    } for question, question_answers in zip(questions, all_answers)]
+    writer.write_many(records)
+    return records
+
+# Answer a batch of questions about one article. The batch is halved while it does not fit the context
+# window, and questions the model skipped are re-asked one at a time.
+def answer_batch(article, questions):
+    if len(questions) == 1:
+        return [response_API_with_retry(article, questions[0])]
+
+    budget = prompt_budget(MODEL_NAME, completion_tokens=min(4096, 256 * len(questions)))
+    prompt = format_batch_prompt(article, questions)
+    response = None
+    if estimate_prompt_tokens(prompt) <= budget:
+        response = client.complete(prompt)
+    if response is None:
+        middle = len(questions) // 2
+        return answer_batch(article, questions[:middle]) + answer_batch(article, questions[middle:])
+
+    blocks = parse_batch_response(response, len(questions))
+    return [block if block is not None else response_API_with_retry(article, question)
+            for question, block in zip(questions, blocks)]
 
-def response_API_with_retry(prompt, article, question):
-    answers = response_API(prompt)
-    if answers is None:
-        for max_token in range(16000, 1, -1):
-            prompt = format_prompt(article=article, question=question, max_token=max_token)
-            answers = response_API(prompt)
-            if answers is not None:
-                break
-    return answers
+# Query the API with the largest article truncation that fits the context window
+def response_API_with_retry(article, question):
+    fit = fit_to_context(lambda max_token: format_prompt(article=article, question=question, max_token=max_token),
+                         client.complete, budget=prompt_budget(MODEL_NAME), high=6000, metrics=client.metrics)
+    if fit.probes > 1:
+        tqdm.write(f"'{question}': truncated to max_token={fit.value} after {fit.probes} probes")
+    return fit.response
 
 if __name__ == "__main__":
+    setup(parser.parse_args())
     main()
\ No newline at end of file
@@ -1,40 +1,47 @@
 import openai
-import backoff
-from openai.error import RateLimitError, APIConnectionError, InvalidRequestError
-import json
 import os
+import re
+import sys
 import argparse
-import nltk
-from nltk import word_tokenize
 from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-# Download NLTK tokenizer
-nltk.download('punkt')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from context_fitting import fit_to_context, prompt_budget
+from token_cache import TokenCache, cache_path_for
+from llm_client import LLMClient, add_client_args
+from jsonl_io import JsonlWriter, completed_keys
+from corpus import ArticleIndex, GroupedIndex, iter_records
+from nltk_resources import ensure_punkt
 
 # Setup argument parser
 parser = argparse.ArgumentParser()
 parser.add_argument('--output_path', type=str, required=True, help="Output file name. Should be a jsonl file.")
-args = parser.parse_args()
-
-# Set API key from environment variable
-openai.api_key = os.environ["OPENAI_API_KEY"]
-
-# Retry logic for API requests
-@backoff.on_exception(backoff.expo, RateLimitError)
-def response_API(prompt):
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=prompt
-        )
-        return response['choices'][0]['message']['content']
-    except (APIConnectionError, InvalidRequestError) as e:
-        print(f"API Error: {e}")
-        return None
-    except Exception as e:
-        print(f"Unexpected Error: {e}")
-        return None
+parser.add_argument('--questions_path', type=str, default="PATH/TO/QUESTIONS.json")
+parser.add_argument('--events_path', type=str, default="PATH/TO/EVENTS.json")
+parser.add_argument('--articles_path', type=str, default="PATH/TO/ARTICLES.json")
+add_client_args(parser)
+
+MODEL_NAME = "gpt-3.5-turbo-16k"
+
+# Set by setup(), from the command line or by run_pipeline.py (which shares its client and token cache with gpt_qa.py)
+args = None
+token_cache = None
+client = None
+
+def setup(parsed_args, shared_client=None, shared_token_cache=None):
+    global args, token_cache, client
+    args = parsed_args
+    ensure_punkt()
+
+    # Set API key from environment variable
+    openai.api_key = os.environ["OPENAI_API_KEY"]
+
+    # Token offsets of every article, computed once and reused across runs.
+    token_cache = shared_token_cache or TokenCache(cache_path_for(args.articles_path))
+
+    client = shared_client or LLMClient.from_args(MODEL_NAME, args)
+
 
 # Format prompt for the API
 def format_prompt(articles, max_token=10000):
@@ -43,9 +50,7 @@ def format_prompt(articles, max_token=10000):
     ]
 
     for article in articles:
-        article_tokens = word_tokenize(article)
-        if len(article_tokens) > max_token:
-            article = ' '.join(article_tokens[:max_token])
+        article = token_cache.truncate(article, max_token)
         messages.append({"role": "user", "content": article})
 
     task_description = """
@@ -58,19 +63,38 @@ def format_prompt(articles, max_token=10000):
 
     return messages
 
-# Function to load data from JSON or JSONL files
-def load_json(filepath):
-    with open(filepath, "r") as f:
-        if filepath.endswith('jsonl'):
-            return [json.loads(line) for line in f.readlines()]
-        else:
-            return json.load(f)
-
-# Process a single event
-def process_event(event, aid2article, questions, output_path):
+# Leading numbering, bullet or label of a question, e.g. '1.', '2)', '-', 'Q3:', 'Question 4:', '**5.**'
+QUESTION_LABEL = r'(?:\*\*|__)?(?:(?:Q|Question)\s*\d+\s*[.):]?|\d+\s*[.):]|[-*\u2022](?=\s))(?:\*\*|__)?'
+# Numbered or bulleted lines of the response, e.g. '1. Who won the election?'
+QUESTION_LINE = re.compile(r'^\s*' + QUESTION_LABEL + r'\s*(.+?)\s*$', re.MULTILINE)
+LEADING_LABEL = re.compile(r'^\s*' + QUESTION_LABEL + r'\s*')
+
+# Sentences of the response ending in '?', for responses that do not put one question per numbered line
+# (e.g. 'Task 1: Who won? What is the vote?'). Labels before a ': ' are dropped.
+def question_sentences(response):
+    questions = []
+    for sentence in re.findall(r'[^?\n]*\?', response):
+        sentence = LEADING_LABEL.sub('', sentence.rsplit(': ', 1)[-1]).strip('*_ ')
+        if len(sentence) > 1:
+            questions.append(sentence)
+    return questions
+
+# The questions of both tasks of a response, in order and without duplicates. None if none are found, so
+# that the event counts as failed and is asked again by the next run.
+def parse_questions(response):
+    if response is None:
+        return None
+    questions = [question.strip('*_ ') for question in QUESTION_LINE.findall(response)]
+    questions = [question for question in questions if question] or question_sentences(response)
+    return list(dict.fromkeys(questions)) or None
+
+# Generate the questions of a single event. 'questions' is the list parsed from the response (the form
+# gpt_qa.py and do_consolidation.py read), None if the call failed or no question could be parsed;
+# 'response' keeps the raw response.
+def generate_questions(event, aid2article, event2questions):
     event_id = event['_id']
     event_aids = event['aids']
-    this_questions = [q for q in questions if q['event_id'] == event_id]
+    this_questions = event2questions[event_id]
     selected_question = this_questions[len(this_questions) // 2]
     top_5_clusters = selected_question['clusters'][:5]
 
@@ -84,44 +108,52 @@ def process_event(event, aid2article, questions, output_path):
             truncated_article = "\n\n".join(middle_article.split("\n\n")[:10])
             selected_articles.append(truncated_article)
     
-    prompt = format_prompt(selected_articles)
-    prediction = response_API_with_retry(prompt, selected_articles)
+    with client.metrics.labels(stage='qg', eid=event_id):
+        prediction = response_API_with_retry(selected_articles, event_id)
     
-    result = {
+    return {
         "eid": event_id,
-        "questions": prediction,
+        "questions": parse_questions(prediction),
+        "response": prediction,
         "aids": event_aids
     }
 
-    with open(output_path, 'a') as f:
-        f.write(json.dumps(result) + '\n')
+# Process a single event
+def process_event(event, aid2article, event2questions, writer):
+    writer.write(generate_questions(event, aid2article, event2questions))
 
-def response_API_with_retry(prompt, articles):
-    prediction = response_API(prompt)
-    if prediction is None:
-        for max_token in range(16000, 1, -1):
-            prompt = format_prompt(articles, max_token=max_token)
-            prediction = response_API(prompt)
-            if prediction is not None:
-                break
-    return prediction
+# Query the API with the largest article truncation that fits the context window
+def response_API_with_retry(articles, event_id):
+    fit = fit_to_context(lambda max_token: format_prompt(articles, max_token=max_token),
+                         client.complete, budget=prompt_budget(MODEL_NAME), high=10000, metrics=client.metrics)
+    if fit.probes > 1:
+        tqdm.write(f"{event_id}: truncated to max_token={fit.value} after {fit.probes} probes")
+    return fit.response
 
 def main():
-    questions = load_json("PATH/TO/QUESTIONS.json")
-    events = load_json("PATH/TO/EVENTS.json")
-    articles = load_json("PATH/TO/ARTICLES.json")
+    # Questions grouped by event_id in one pass (cached in a sidecar file next to the questions file).
+    event2questions = GroupedIndex(args.questions_path, key='event_id')
+    # Articles are read from disk by id instead of being held in memory.
+    aid2article = ArticleIndex(args.articles_path)
 
-    # Create lookup dictionaries to access articles and events by ID
-    aid2article = {a["_id"]: a for a in articles}
-    eid2event = {e["_id"]: e for e in events}
+    # Skip the events already processed by a previous run; events without questions are tried again.
+    completed_eids = completed_keys(args.output_path, lambda record: record['eid'] if record['questions'] is not None else None)
+    events = (event for event in iter_records(args.events_path) if event['_id'] not in completed_eids)
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    # The writer is closed (flushing what is queued) even if a task fails.
+    with JsonlWriter(args.output_path) as writer, ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
         futures = []
         for event in tqdm(events):
-            futures.append(executor.submit(process_event, event, aid2article, questions, args.output_path))
+            futures.append(executor.submit(process_event, event, aid2article, event2questions, writer))
 
         for future in futures:
             future.result()
 
+    aid2article.close()
+    event2questions.close()
+    token_cache.save()
+    client.close()
+
 if __name__ == "__main__":
+    setup(parser.parse_args())
     main()
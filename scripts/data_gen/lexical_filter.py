@@ -0,0 +1,91 @@
+# Cheap lexical similarity between all answers of a question, used to skip cross-encoder calls for
+# answer pairs that share (almost) no words. Both measures are computed for all pairs at once with NumPy.
+# article_relevance does the same for questions and articles (BM25 over article passages), so that
+# gpt_qa.py can skip API calls for articles that cannot answer a question.
+import re
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+# Term count matrix (n_texts x vocabulary) for a list of texts.
+def term_counts(texts):
+    vocab = {}
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        for token in tokenize(text):
+            rows.append(row)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    counts = np.zeros((len(texts), max(len(vocab), 1)))
+    np.add.at(counts, (rows, cols), 1)
+    return counts
+
+
+# Cosine similarity of TF-IDF vectors.
+def tfidf_similarity(texts):
+    counts = term_counts(texts)
+    document_frequency = (counts > 0).sum(axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    vectors = counts * idf
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    return vectors @ vectors.T
+
+
+# Jaccard similarity of token sets.
+def jaccard_similarity(texts):
+    present = (term_counts(texts) > 0).astype(float)
+    intersection = present @ present.T
+    sizes = present.sum(axis=1)
+    union = sizes[:, None] + sizes[None, :] - intersection
+    return intersection / np.where(union == 0, 1, union)
+
+
+SIMILARITY_FUNCTIONS = {
+    "tfidf": tfidf_similarity,
+    "jaccard": jaccard_similarity,
+}
+
+
+def lexical_similarity(texts, method="tfidf"):
+    return SIMILARITY_FUNCTIONS[method](texts)
+
+
+# BM25 score of every query against every passage (n_queries x n_passages), with IDF over the passages.
+def bm25_scores(queries, passages, k1=1.5, b=0.75):
+    counts = term_counts(list(passages) + list(queries))
+    passage_counts, query_terms = counts[:len(passages)], (counts[len(passages):] > 0).astype(float)
+    document_frequency = (passage_counts > 0).sum(axis=0)
+    idf = np.log(1 + (len(passages) - document_frequency + 0.5) / (document_frequency + 0.5))
+    lengths = passage_counts.sum(axis=1, keepdims=True)
+    saturation = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+    weights = passage_counts * (k1 + 1) / (passage_counts + saturation) * idf
+    return query_terms @ weights.T
+
+
+# Paragraphs of an article, with long ones cut into windows of passage_words words.
+def article_passages(article, passage_words=100):
+    passages = []
+    for paragraph in article.split("\n\n"):
+        words = paragraph.split()
+        for start in range(0, len(words), passage_words):
+            passages.append(" ".join(words[start:start + passage_words]))
+    return passages or [""]
+
+
+# Relevance of every article to every question (n_questions x n_articles): the BM25 score of the article's
+# best passage relative to that of the question's best article, so between 0 and 1. A question that
+# shares no word with any article gets 1 everywhere, as there is nothing to tell the articles apart.
+def article_relevance(questions, articles, passage_words=100):
+    if not articles:
+        return np.ones((len(questions), 0))
+    passages = [article_passages(article, passage_words) for article in articles]
+    starts = np.cumsum([0] + [len(article) for article in passages[:-1]])
+    scores = bm25_scores(questions, [passage for article in passages for passage in article])
+    best = np.maximum.reduceat(scores, starts, axis=1)
+    top = best.max(axis=1, keepdims=True)
+    return np.where(top > 0, best / np.where(top > 0, top, 1), 1.0)
@@ -1,12 +1,35 @@
 # copied from https://github.com/salesforce/discord_questions/blob/master/model_consolidation.py
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
-import networkx as nx, numpy as np, community, torch, tqdm
+import networkx as nx, numpy as np, community, re, time, tqdm
+from lexical_filter import lexical_similarity
+
+# Score given to answer pairs pruned by the lexical pre-filter, well below any useful threshold.
+PRUNED_SCORE = -5.0
+
+# Answers that differ only in case, whitespace or surrounding punctuation are treated as identical.
+def normalize_answer(answer):
+    return re.sub(r"\s+", " ", answer.lower()).strip(" .,;:!?'\"")
 
 class ConsolidationModel:
-    def __init__(self, model_card, model_file=None, device="cuda"):
+    def __init__(self, model_card, model_file=None, device="cuda", max_batch_tokens=16384, score_cache=None,
+                 prefilter=None, prefilter_floor=0.05, quantize=False, num_threads=None, metrics=None):
+        # torch and transformers take seconds to import; scripts that only use the graph functions below
+        # (rethreshold.py) or exit early (--help, nothing left to consolidate) never load them.
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
         self.model_card = model_card
         self.model_file = model_file
         self.device = device
+        # Optional ScoreCache shared across runs.
+        self.score_cache = score_cache
+        # Optional lexical pre-filter ("tfidf" or "jaccard"): pairs less similar than prefilter_floor
+        # get PRUNED_SCORE instead of a model call.
+        self.prefilter = prefilter
+        self.prefilter_floor = prefilter_floor
+        # Optional metrics object (see scripts/metrics.py) recording tokenization and every forward pass.
+        self.metrics = metrics
+        self.stats = {"pairs": 0, "pairs_after_dedup": 0, "pairs_pruned": 0, "pairs_scored": 0, "cache_hits": 0}
+        # Upper bound on padded tokens (batch size x longest sequence) per forward pass.
+        self.max_batch_tokens = max_batch_tokens
         self.tokenizer = AutoTokenizer.from_pretrained(model_card)
         self.model = AutoModelForSequenceClassification.from_pretrained(model_card).to(self.device)
 
@@ -15,20 +38,55 @@ class ConsolidationModel:
             print(self.model.load_state_dict(loaded_dict))
         self.model.eval()
 
+        # CPU inference: `num_threads` sets the intra-op threads (torch's own default otherwise), and `quantize`
+        # swaps the Linear layers for dynamically quantized int8 ones (scores shift slightly, see
+        # benchmarks/bench_cpu_inference.py).
+        if self.device == "cpu" and num_threads:
+            torch.set_num_threads(num_threads)
+        if quantize:
+            if self.device != "cpu":
+                raise ValueError("int8 dynamic quantization is only supported on CPU")
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    # Split indices, sorted by length, into batches whose padded size stays under max_batch_tokens.
+    def length_batches(self, lengths):
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches, batch = [], []
+        for i in order:
+            # Lengths are increasing, so lengths[i] is the longest sequence of the batch.
+            if batch and (len(batch) + 1) * lengths[i] > self.max_batch_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
     def get_logits(self, texts):
-        input_ids = [torch.LongTensor(self.tokenizer.encode(text)) for text in texts]
-        input_ids = torch.nn.utils.rnn.pad_sequence(input_ids, batch_first=True).to(self.device)
+        import torch
+        start = time.perf_counter()
+        input_ids = self.tokenizer(texts, truncation=True)["input_ids"]
+        if self.metrics is not None:
+            self.metrics.record("tokenize", stage="consolidation", texts=len(texts), latency=time.perf_counter() - start)
+        # Rows are returned in the order of `texts`.
+        logits = torch.zeros((len(texts), self.model.config.num_labels))
 
         self.model.eval()
-        with torch.no_grad():
-            model_outs = self.model(input_ids=input_ids)
-            logits = model_outs["logits"]
+        with torch.inference_mode():
+            for batch in self.length_batches([len(ids) for ids in input_ids]):
+                start = time.perf_counter()
+                inputs = self.tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt").to(self.device)
+                model_outs = self.model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+                logits[torch.LongTensor(batch)] = model_outs["logits"].float().cpu()
+                if self.metrics is not None:
+                    self.metrics.record("model_batch", stage="consolidation", batch_size=len(batch),
+                                        tokens=int(inputs["attention_mask"].sum()), padded_tokens=inputs["input_ids"].numel(),
+                                        latency=time.perf_counter() - start)
         return logits
 
     def score_batch(self, questions, answers1, answers2, contexts1):
         texts = ["%s <sep> %s <sep> %s" % (q, a1, a2) for q, a1, a2 in zip(questions, answers1, answers2)]
-        with torch.no_grad():
-            logits = self.get_logits(texts)
+        logits = self.get_logits(texts)
         return {"scores": logits[:, 0].tolist()}
 
     def score(self, questions, answers1, answers2, contexts1, contexts2=None, batch_size=32, progress=False):
@@ -52,20 +110,34 @@ class ConsolidationModel:
     def compare_batch(self, question, p1s, p2s):
         scores = []
 
-        to_do = [i for i in range(len(p1s)) if p1s[i]["answer"] != p2s[i]["answer"]]
-        questions = [question] * len(to_do)
-        contexts = [""] * len(to_do)
+        to_do = [i for i in range(len(p1s)) if normalize_answer(p1s[i]["answer"]) != normalize_answer(p2s[i]["answer"])]
         answers1 = [p1s[i]["answer"] for i in to_do]
         answers2 = [p2s[i]["answer"] for i in to_do]
         idx2score = {}
+        if self.score_cache is not None and len(to_do) > 0:
+            cached = self.score_cache.get_many(question, answers1, answers2)
+            self.stats["cache_hits"] += len(cached)
+            idx2score = {to_do[idx]: score for idx, score in cached.items()}
+            remaining = [idx for idx in range(len(to_do)) if idx not in cached]
+            to_do = [to_do[idx] for idx in remaining]
+            answers1 = [answers1[idx] for idx in remaining]
+            answers2 = [answers2[idx] for idx in remaining]
         if len(to_do) > 0:
+            questions = [question] * len(to_do)
+            contexts = [""] * len(to_do)
             non_triv_scores = self.score_batch(questions, answers1, answers2, contexts1=contexts)["scores"]
-            idx2score = {i: non_triv_scores[idx] for idx, i in enumerate(to_do)}
+            self.stats["pairs_scored"] += len(to_do)
+            idx2score.update({i: non_triv_scores[idx] for idx, i in enumerate(to_do)})
+            if self.score_cache is not None:
+                self.score_cache.put_many(question, answers1, answers2, non_triv_scores)
         scores = [idx2score.get(i, 5.0) for i in range(len(p1s))]
         return {"scores": scores}
 
-    def compare(self, question, p1s, p2s, batch_size=512, progress=True):
+    def compare(self, question, p1s, p2s, batch_size=None, progress=True):
+        # get_logits already forms length-bucketed, token-bounded batches; batch_size only splits the
+        # pairs into chunks for the progress bar.
         N = len(p1s)
+        batch_size = batch_size or max(N, 1)
         scores = []
         ite = range(0, N, batch_size)
         if progress and len(ite) > 1:
@@ -77,32 +149,203 @@ class ConsolidationModel:
             scores.extend(batch_scores["scores"])
         return {"scores": scores}
 
+    # Work left for one question: its answers are deduplicated by normalized text, pairs dropped by the
+    # lexical pre-filter or found in the score cache are filled in, and the remaining ordered pairs of
+    # distinct answers (rows, cols) are the ones the model has to score. `needed`, an optional n x n
+    # boolean mask over paragraphs, limits scoring to those pairs; the others keep a placeholder score.
+    def plan_pairs(self, question, paragraphs, needed=None):
+        keys = [normalize_answer(p["answer"]) for p in paragraphs]
+        key2idx = {}
+        unique_paragraphs = []
+        for p, key in zip(paragraphs, keys):
+            if key not in key2idx:
+                key2idx[key] = len(unique_paragraphs)
+                unique_paragraphs.append(p)
+        U = len(unique_paragraphs)
+        idx = np.array([key2idx[key] for key in keys], dtype=int)
+        candidates = ~np.eye(U, dtype=bool)
+        if needed is None:
+            self.stats["pairs"] += len(paragraphs) * (len(paragraphs) - 1)
+        else:
+            needed = needed & ~np.eye(len(paragraphs), dtype=bool)
+            self.stats["pairs"] += int(needed.sum())
+            unique_needed = np.zeros((U, U), dtype=bool)
+            rows, cols = np.nonzero(needed)
+            unique_needed[idx[rows], idx[cols]] = True
+            candidates &= unique_needed
+        self.stats["pairs_after_dedup"] += int(candidates.sum())
+        unique_scores = np.full((U, U), 5.0)
+        if self.prefilter is not None and U > 1:
+            similarity = lexical_similarity([p["answer"] for p in unique_paragraphs], method=self.prefilter)
+            pruned = candidates & (similarity < self.prefilter_floor)
+            unique_scores[pruned] = PRUNED_SCORE
+            candidates &= ~pruned
+            self.stats["pairs_pruned"] += int(pruned.sum())
+
+        rows, cols = np.nonzero(candidates)
+        answers1 = [unique_paragraphs[i]["answer"] for i in rows]
+        answers2 = [unique_paragraphs[j]["answer"] for j in cols]
+        if self.score_cache is not None and len(rows) > 0:
+            cached = self.score_cache.get_many(question, answers1, answers2)
+            self.stats["cache_hits"] += len(cached)
+            hit = np.zeros(len(rows), dtype=bool)
+            for pair_idx, score in cached.items():
+                unique_scores[rows[pair_idx], cols[pair_idx]] = score
+                hit[pair_idx] = True
+            answers1 = [a for a, h in zip(answers1, hit) if not h]
+            answers2 = [a for a, h in zip(answers2, hit) if not h]
+            rows, cols = rows[~hit], cols[~hit]
+        return {"question": question, "idx": idx,
+                "unique_scores": unique_scores, "rows": rows, "cols": cols, "answers1": answers1, "answers2": answers2}
+
+    # Fill in the model scores of a plan's remaining pairs and fan them back out to all paragraphs.
+    def finish_pairs(self, plan, scores):
+        if len(scores) > 0:
+            plan["unique_scores"][plan["rows"], plan["cols"]] = scores
+            if self.score_cache is not None:
+                self.score_cache.put_many(plan["question"], plan["answers1"], plan["answers2"], scores)
+        pair_scores = plan["unique_scores"][np.ix_(plan["idx"], plan["idx"])]
+        np.fill_diagonal(pair_scores, 0)
+        return (pair_scores + pair_scores.T) / 2
+
+    # Score matrices of many (question, paragraphs) items at once. The pairs of all items go through the
+    # model together, so questions with few answers still fill the length-bucketed batches of get_logits.
+    def score_matrices(self, items, needed=None):
+        needed = needed or [None] * len(items)
+        plans = [self.plan_pairs(question, paragraphs, mask) for (question, paragraphs), mask in zip(items, needed)]
+        questions, answers1, answers2 = [], [], []
+        for plan in plans:
+            questions += [plan["question"]] * len(plan["answers1"])
+            answers1 += plan["answers1"]
+            answers2 += plan["answers2"]
+        scores = []
+        if len(questions) > 0:
+            scores = self.score_batch(questions, answers1, answers2, contexts1=[""] * len(questions))["scores"]
+            self.stats["pairs_scored"] += len(questions)
+        matrices = []
+        offset = 0
+        for plan in plans:
+            num_pairs = len(plan["answers1"])
+            matrices.append(self.finish_pairs(plan, scores[offset:offset + num_pairs]))
+            offset += num_pairs
+        return matrices
+
+    # Symmetric n x n matrix of averaged pair scores, (s(i, j) + s(j, i)) / 2, with a zero diagonal.
+    # Each ordered pair of distinct normalized answers is scored once, then the score is fanned back
+    # out to every paragraph carrying that answer.
+    def score_matrix(self, question, paragraphs):
+        return self.score_matrices([(question, paragraphs)])[0]
+
     def build_graph(self, question, paragraphs, thresh=2.75):
-        paragraph_pairs = [{"p1": p1, "p1_idx": i, "p2": p2, "p2_idx": j} for i, p1 in enumerate(paragraphs) for j, p2 in enumerate(paragraphs) if i != j]
-        p1s = [p["p1"] for p in paragraph_pairs]
-        p2s = [p["p2"] for p in paragraph_pairs]
-
-        scores = self.compare(question, p1s, p2s, batch_size=512, progress=False)["scores"]
-        weight_matrix = np.zeros((len(paragraphs), len(paragraphs)))
-        for p, s in zip(paragraph_pairs, scores):
-            p["score"] = s
-            weight_matrix[p["p1_idx"], p["p2_idx"]] += s / 2
-            weight_matrix[p["p2_idx"], p["p1_idx"]] += s / 2
-        weight_matrix = weight_matrix > thresh
-        G = nx.from_numpy_matrix(weight_matrix)
-        return G
-
-    def consolidate(self, question, paragraphs):
-        G = self.build_graph(question, paragraphs)
-        sub_parts = community.best_partition(G, randomize=False)
-        sub_comps = {}
-        for top, c in sub_parts.items():
-            if c not in sub_comps:
-                sub_comps[c] = set([])
-            sub_comps[c].add(top)
-
-        groups = sorted(sub_comps.values(), key=len, reverse=True)
-        answer_groups = []
-        for group in groups:
-            answer_groups.append([paragraphs[i]["answer"] for i in group])
-        return answer_groups
\ No newline at end of file
+        return graph_from_scores(self.score_matrix(question, paragraphs), thresh)
+
+    # If a ScoreStore and eid are given, the raw score matrix is saved so that the answers can later be
+    # re-consolidated at other thresholds with consolidate_from_scores.
+    def consolidate(self, question, paragraphs, thresh=2.75, score_store=None, eid=None, backend="louvain"):
+        weight_matrix = self.score_matrix(question, paragraphs)
+        if score_store is not None:
+            score_store.put(eid, question, paragraphs, weight_matrix)
+        return consolidate_from_scores(weight_matrix, paragraphs, thresh, backend=backend)
+
+    # Add new answers to an earlier consolidation of `question` without rescoring it. Only new-vs-existing
+    # and new-vs-new pairs go through the model, k * (2n + k) pairs for k new answers instead of (n + k)^2,
+    # and Louvain starts from the existing answer_groups. Existing pairs are taken from `existing_scores`,
+    # the (paragraphs, weight_matrix) that ScoreStore.get returns for the question, or else approximated
+    # from answer_groups: answers of a group are linked, answers of different groups are not.
+    def update(self, question, answer_groups, new_paragraphs, thresh=2.75, existing_scores=None, score_store=None,
+               eid=None, backend="louvain"):
+        answer2group = {answer: group_idx for group_idx, group in enumerate(answer_groups) for answer in group}
+        if existing_scores is not None:
+            existing, existing_matrix = existing_scores
+        else:
+            if score_store is not None:
+                raise ValueError("only updates built on stored existing_scores can be saved to the score store")
+            existing = [{"answer": answer} for group in answer_groups for answer in group]
+            group_ids = np.array([answer2group[p["answer"]] for p in existing], dtype=int)
+            existing_matrix = np.where(group_ids[:, None] == group_ids[None, :], 5.0, PRUNED_SCORE)
+        paragraphs = list(existing) + list(new_paragraphs)
+        E = len(existing)
+
+        needed = np.ones((len(paragraphs), len(paragraphs)), dtype=bool)
+        needed[:E, :E] = False
+        weight_matrix = self.score_matrices([(question, paragraphs)], needed=[needed])[0]
+        weight_matrix[:E, :E] = existing_matrix
+        np.fill_diagonal(weight_matrix, 0)
+        if score_store is not None:
+            score_store.put(eid, question, paragraphs, weight_matrix)
+
+        # Existing answers start in their group (or alone if no longer in one), new answers alone.
+        initial, num_groups = {}, len(answer_groups)
+        for i, p in enumerate(paragraphs):
+            if i < E and p["answer"] in answer2group:
+                initial[i] = answer2group[p["answer"]]
+            else:
+                initial[i] = num_groups
+                num_groups += 1
+        G = graph_from_scores(weight_matrix, thresh)
+        return partition_answers(G, paragraphs, backend=backend, initial=initial)
+
+
+# Graph with one node per paragraph and an edge for every pair scoring above `thresh`. Edges are
+# added straight from the above-threshold pairs (upper triangle, row-major, as nx.from_numpy_matrix
+# did) so no dense adjacency is handed to networkx.
+def graph_from_scores(weight_matrix, thresh=2.75):
+    weight_matrix = np.asarray(weight_matrix)
+    rows, cols = np.nonzero(np.triu(weight_matrix > thresh))
+    G = nx.Graph()
+    G.add_nodes_from(range(len(weight_matrix)))
+    G.add_edges_from(zip(rows.tolist(), cols.tolist()), weight=1)
+    return G
+
+
+def is_clique(G, nodes):
+    k = len(nodes)
+    return k <= 2 or G.subgraph(nodes).number_of_edges() == k * (k - 1) // 2
+
+
+# Node -> community id, with ids numbered by first node as community.best_partition does. `initial`
+# (node -> community id) is the partition Louvain starts from; igraph has no equivalent and ignores it.
+# When every connected component is a clique (and there are no self-loops, which only a negative
+# threshold produces), Louvain would return exactly the components, so they are used directly.
+# Otherwise `backend` runs the community detection: "louvain" (python-louvain, the reference) or
+# "igraph" (igraph's multilevel implementation, much faster on large graphs, optional).
+def community_partition(G, backend="louvain", initial=None):
+    components = list(nx.connected_components(G))
+    if nx.number_of_selfloops(G) == 0 and all(is_clique(G, component) for component in components):
+        node2component = {node: idx for idx, component in enumerate(components) for node in component}
+    elif backend == "igraph":
+        import igraph
+        nodes = list(G.nodes())
+        node_idx = {node: idx for idx, node in enumerate(nodes)}
+        ig = igraph.Graph(n=len(nodes), edges=[(node_idx[u], node_idx[v]) for u, v in G.edges() if u != v])
+        membership = ig.community_multilevel().membership
+        node2component = {node: membership[idx] for idx, node in enumerate(nodes)}
+    else:
+        return community.best_partition(G, partition=initial, randomize=False)
+    renumber = {}
+    return {node: renumber.setdefault(node2component[node], len(renumber)) for node in G.nodes()}
+
+
+def partition_answers(G, paragraphs, backend="louvain", initial=None):
+    sub_parts = community_partition(G, backend=backend, initial=initial)
+    sub_comps = {}
+    for top, c in sub_parts.items():
+        if c not in sub_comps:
+            sub_comps[c] = set([])
+        sub_comps[c].add(top)
+
+    groups = sorted(sub_comps.values(), key=len, reverse=True)
+    answer_groups = []
+    for group in groups:
+        answer_groups.append([paragraphs[i]["answer"] for i in group])
+    return answer_groups
+
+
+# Group answers from a precomputed score matrix; needs no model.
+def consolidate_from_scores(weight_matrix, paragraphs, thresh=2.75, backend="louvain"):
+    return partition_answers(graph_from_scores(weight_matrix, thresh), paragraphs, backend=backend)
+
+
+# Answer groups for each threshold in `thresholds`, from one score matrix.
+def sweep_thresholds(weight_matrix, paragraphs, thresholds, backend="louvain"):
+    return {thresh: consolidate_from_scores(weight_matrix, paragraphs, thresh, backend=backend) for thresh in thresholds}
@@ -0,0 +1,52 @@
+# Re-consolidate answers at other thresholds from the score matrices saved by
+# `do_consolidation.py --score_store`, without loading the consolidation model.
+# Writes one file per threshold in the same per-event JSONL format as do_consolidation.py, e.g.
+#   python rethreshold.py --score_store scores/ --thresholds 2.0 2.75 3.5 --output_path consolidated_{thresh}.jsonl
+import argparse
+import os
+import sys
+from contextlib import ExitStack
+from tqdm import tqdm
+from model_consolidation import sweep_thresholds
+from score_store import ScoreStore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from jsonl_io import JsonlWriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--score_store', type=str, required=True, help="Directory written by do_consolidation.py --score_store.")
+parser.add_argument('--thresholds', type=float, nargs='+', required=True)
+parser.add_argument('--output_path', type=str, required=True, help="Output path containing '{thresh}'.")
+parser.add_argument('--community_backend', type=str, default='louvain', choices=['louvain', 'igraph'], help="Community detection for graphs that are not disjoint cliques; 'igraph' needs python-igraph.")
+args = parser.parse_args()
+
+
+def main():
+    store = ScoreStore(args.score_store)
+
+    # Group the stored questions by event, keeping the order in which they were consolidated.
+    eid2questions = {}
+    for eid, question in store.keys():
+        eid2questions.setdefault(eid, []).append(question)
+
+    # Every writer is closed (flushing what is queued) even if a question fails.
+    with ExitStack() as stack:
+        writers = {thresh: stack.enter_context(JsonlWriter(args.output_path.format(thresh=thresh), append=False))
+                   for thresh in args.thresholds}
+        for eid, questions in tqdm(eid2questions.items()):
+            results = {thresh: [] for thresh in args.thresholds}
+            for question in questions:
+                paragraphs, weight_matrix = store.get(eid, question)
+                try:
+                    groups = sweep_thresholds(weight_matrix, paragraphs, args.thresholds, backend=args.community_backend)
+                except Exception as e:
+                    print(f"Error consolidating answers: {e}")
+                    groups = {thresh: [] for thresh in args.thresholds}
+                for thresh in args.thresholds:
+                    results[thresh].append({'eid': eid, 'question': question, 'answer_groups': groups[thresh]})
+            for thresh in args.thresholds:
+                writers[thresh].write(results[thresh])
+
+
+if __name__ == "__main__":
+    main()
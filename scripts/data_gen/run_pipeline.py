@@ -0,0 +1,225 @@
+# Streaming data generation: every event goes through question generation (gpt_qg.py), question answering
+# (gpt_qa.py) and answer consolidation (do_consolidation.py) as soon as its previous stage is done,
+# instead of each script waiting for the whole output file of the previous one.
+# The two API stages run on threads sharing one LLMClient (and so its concurrency and rate limits) while
+# consolidation runs the model on the main thread (or in worker processes), so API calls and model batches
+# overlap. Stages are connected by bounded queues: a slow stage holds back the ones before it instead of
+# letting their results pile up in memory.
+# The three output files have the records the scripts write, and answers are joined to their questions by
+# eid. Consolidated events are written as they finish. A rerun skips the events already consolidated and
+# reuses the questions and answers already on disk; events that could not be consolidated are left out of
+# the output and retried by the next run.
+#   python run_pipeline.py --events_path events.json --questions_path questions.json --articles_path articles.json \
+#       --qg_output_path generated_questions.jsonl --qa_output_path generated_answers.jsonl \
+#       --output_path consolidated.jsonl --device cpu
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from tqdm import tqdm
+import do_consolidation
+import gpt_qa
+import gpt_qg
+from score_store import ScoreStore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from token_cache import TokenCache, cache_path_for
+from llm_client import LLMClient, add_client_args
+from jsonl_io import JsonlWriter, read_jsonl_output
+from corpus import ArticleIndex, GroupedIndex, iter_records
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--events_path', type=str, default="PATH/TO/EVENTS.json")
+parser.add_argument('--questions_path', type=str, default="PATH/TO/QUESTIONS.json")
+parser.add_argument('--articles_path', type=str, default="PATH/TO/ARTICLES.json")
+parser.add_argument('--qg_output_path', type=str, required=True, help="Generated questions, one record per event.")
+parser.add_argument('--qa_output_path', type=str, required=True, help="Generated answers, one record per question.")
+parser.add_argument('--output_path', type=str, required=True, help="Consolidated answers, one line per event.")
+parser.add_argument('--questions_per_call', type=int, default=1, help="Number of questions answered per API call (see gpt_qa.py).")
+parser.add_argument('--relevance_cutoff', type=float, default=None, help="Skip the QA call for articles below this BM25 relevance to the question (see gpt_qa.py).")
+parser.add_argument('--queue_size', type=int, default=16, help="Events waiting between two stages before the earlier stage is held back.")
+add_client_args(parser)
+do_consolidation.add_consolidation_args(parser)
+args = parser.parse_args()
+
+# End of a stage's input.
+STOP = object()
+
+
+# Threads that take items from `inbox`, apply `fn` and put the results (unless None) on `outbox`.
+# STOP ends the stage once the items before it are done, and is then passed on to the next stage.
+class Stage:
+    def __init__(self, name, fn, inbox, outbox, num_threads):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.lock = threading.Lock()
+        self.running = num_threads
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            if item is STOP:
+                # Let the other threads of the stage see it too.
+                self.inbox.put(STOP)
+                break
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                # The event is left out of this run's later stages and retried by the next run.
+                tqdm.write(f"{self.name}: error on event {item.get('eid', item.get('_id'))}: {e}")
+                result = None
+            if result is not None:
+                self.outbox.put(result)
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self.outbox.put(STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+# The generated questions of a record, parsed if it was written when gpt_qg.py stored the raw response.
+def event_questions(record):
+    questions = record['questions']
+    return gpt_qg.parse_questions(questions) if isinstance(questions, str) else questions
+
+
+# Options of do_consolidation.py. Model batches are traced next to the API calls, in <root>.consolidation<ext>.
+def consolidation_args():
+    metrics_path = None
+    if args.metrics_path:
+        root, ext = os.path.splitext(args.metrics_path)
+        metrics_path = f"{root}.consolidation{ext}"
+    return argparse.Namespace(**{**vars(args), 'metrics_path': metrics_path})
+
+
+# Batches of (event, items) for do_consolidation.py: whatever has arrived, up to about args.batch_pairs
+# answer pairs, without waiting for more events once the queue is empty.
+def consolidation_batches(inbox):
+    while True:
+        item = inbox.get()
+        if item is STOP:
+            return
+        batch, batch_pairs = [item], do_consolidation.pair_bound(item[1])
+        while batch_pairs < args.batch_pairs:
+            try:
+                item = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is STOP:
+                yield batch
+                return
+            batch.append(item)
+            batch_pairs += do_consolidation.pair_bound(item[1])
+        yield batch
+
+
+def main():
+    # One client for both API stages, which use the same model.
+    assert gpt_qg.MODEL_NAME == gpt_qa.MODEL_NAME
+    client = LLMClient.from_args(gpt_qg.MODEL_NAME, args)
+    token_cache = TokenCache(cache_path_for(args.articles_path))
+    gpt_qg.setup(args, shared_client=client, shared_token_cache=token_cache)
+    gpt_qa.setup(args, shared_client=client, shared_token_cache=token_cache)
+    do_consolidation.setup(consolidation_args())
+
+    # Work left by a previous run: consolidated events are skipped, generated questions and answers reused.
+    consolidated = {results[0]['eid'] for results in read_jsonl_output(args.output_path) if results}
+    eid2generated = {record['eid']: record for record in read_jsonl_output(args.qg_output_path) if record['questions'] is not None}
+    eid2answers = {}
+    for record in read_jsonl_output(args.qa_output_path):
+        eid2answers.setdefault(record['eid'], []).append(record)
+
+    aid2article = ArticleIndex(args.articles_path)
+    event2questions = GroupedIndex(args.questions_path, key='event_id')
+    # The questions of the events being answered share one pool, so an event is done as soon as possible.
+    question_pool = ThreadPoolExecutor(max_workers=args.max_concurrency)
+
+    def generate(event):
+        if event['_id'] in eid2generated:
+            return eid2generated[event['_id']]
+        record = gpt_qg.generate_questions(event, aid2article, event2questions)
+        if record['questions'] is None:
+            tqdm.write(f"qg: no questions for event {event['_id']}")
+            return None
+        qg_writer.write(record)
+        return record
+
+    def answer(record):
+        eid, aids = record['eid'], record['aids']
+        questions = event_questions(record)
+        if not questions:
+            return None
+        answer_records = list(eid2answers.get(eid, []))
+        # Questions with a failed call are answered again; event_paragraphs uses the later record.
+        answered = {answer_record['question'] for answer_record in answer_records if None not in answer_record['answers']}
+        pending = [question for question in questions if question not in answered]
+        if pending:
+            articles_content = [aid2article[aid]['content'] for aid in aids]
+            skip = gpt_qa.irrelevant_articles(pending, articles_content)
+            if args.questions_per_call > 1:
+                answer_records += gpt_qa.process_event_batched(eid, aids, pending, articles_content, qa_writer, args.questions_per_call, skip)
+            else:
+                futures = [question_pool.submit(gpt_qa.process_question, eid, aids, question, articles_content, qa_writer,
+                                                None if skip is None else skip[idx])
+                           for idx, question in enumerate(pending)]
+                answer_records += [future.result() for future in futures]
+        event = {'eid': eid, 'aids': aids, 'questions': questions}
+        return event, do_consolidation.event_paragraphs(event, answer_records)
+
+    # The writers of the API stages are closed (flushing what is queued) even if a stage fails.
+    with JsonlWriter(args.qg_output_path) as qg_writer, JsonlWriter(args.qa_output_path) as qa_writer:
+        qg_inbox, qa_inbox, consolidation_inbox = (queue.Queue(maxsize=args.queue_size) for _ in range(3))
+        stages = [Stage('qg', generate, qg_inbox, qa_inbox, args.max_concurrency),
+                  Stage('qa', answer, qa_inbox, consolidation_inbox, args.max_concurrency)]
+
+        def feed():
+            for event in iter_records(args.events_path):
+                if event['_id'] not in consolidated:
+                    qg_inbox.put(event)
+            qg_inbox.put(STOP)
+
+        threading.Thread(target=feed, daemon=True).start()
+
+        start = time.perf_counter()
+        batches = consolidation_batches(consolidation_inbox)
+        # The model (or the worker pool) is only loaded once the first event reaches consolidation.
+        first_batch = next(batches, None)
+        if first_batch is None:
+            print(f"Nothing to consolidate: {len(consolidated)} events are already in {args.output_path}")
+        else:
+            batches = chain([first_batch], batches)
+            score_store = ScoreStore(args.score_store) if args.score_store else None
+            outputs = do_consolidation.run_sharded(batches) if args.num_workers > 1 else do_consolidation.run_in_process(batches)
+            with JsonlWriter(args.output_path) as writer:
+                progress = tqdm(initial=len(consolidated))
+                stats = do_consolidation.write_outputs(outputs, writer, score_store, progress, skip_failed=True)
+                progress.close()
+            do_consolidation.print_stats(stats, time.perf_counter() - start)
+            # One summary for the API calls and the model batches.
+            client.metrics.merge(do_consolidation.metrics.take_totals())
+            do_consolidation.metrics.close()
+
+        for stage in stages:
+            stage.join()
+    question_pool.shutdown()
+    aid2article.close()
+    event2questions.close()
+    token_cache.save()
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
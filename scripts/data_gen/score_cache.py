@@ -0,0 +1,52 @@
+# Persistent (question, answer1, answer2) -> score cache for ConsolidationModel.
+# Backed by SQLite in WAL mode, so reruns and concurrent processes can share it. Keys include the
+# model card and weights file, so scores from a different model are never reused.
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+class ScoreCache:
+    def __init__(self, path, model_id):
+        self.path = path
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL NOT NULL)")
+
+    def key(self, question, answer1, answer2):
+        payload = "\0".join([self.model_id, question, answer1, answer2])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    # Returns {index: score} for the (answer1, answer2) pairs found in the cache.
+    def get_many(self, question, answers1, answers2):
+        keys = [self.key(question, a1, a2) for a1, a2 in zip(answers1, answers2)]
+        found = {}
+        with self.lock:
+            # Stay well below SQLite's limit on the number of bound parameters.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute("SELECT key, score FROM scores WHERE key IN (%s)" % ",".join("?" * len(chunk)),
+                                         chunk).fetchall()
+                found.update(rows)
+            scores = {i: found[key] for i, key in enumerate(keys) if key in found}
+            self.hits += len(scores)
+            self.misses += len(keys) - len(scores)
+        return scores
+
+    def put_many(self, question, answers1, answers2, scores):
+        rows = [(self.key(question, a1, a2), float(s)) for a1, a2, s in zip(answers1, answers2, scores)]
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO scores (key, score) VALUES (?, ?)", rows)
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,65 @@
+# On-disk store of the symmetric answer-pair score matrices computed by ConsolidationModel.
+# Matrices of all (eid, question) pairs are appended as float32 to one data file that is read back
+# through np.memmap, and an index.jsonl records where each matrix starts plus its paragraphs. With the
+# raw scores stored, answers can be re-consolidated at any threshold without loading the model.
+import json
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from jsonl_io import read_jsonl_output
+
+DTYPE = np.float32
+
+
+class ScoreStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'scores.f32')
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.entries = {}
+        end = 0
+        for entry in read_jsonl_output(self.index_path):
+            self.entries[(entry['eid'], entry['question'])] = entry
+            end = max(end, entry['offset'] + entry['n'] * entry['n'])
+        # Drop matrix data written after the last indexed entry (e.g. by an interrupted run).
+        with open(self.data_path, 'ab') as f:
+            f.truncate(end * DTYPE().itemsize)
+        self.size = end
+        self.data = None
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def put(self, eid, question, paragraphs, weight_matrix):
+        n = len(paragraphs)
+        matrix = np.ascontiguousarray(weight_matrix, dtype=DTYPE).reshape(n, n)
+        with open(self.data_path, 'ab') as f:
+            f.write(matrix.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        entry = {'eid': eid, 'question': question, 'offset': self.size, 'n': n,
+                 'paragraphs': [{'answer': p['answer'], 'aid': p.get('aid')} for p in paragraphs]}
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.entries[(eid, question)] = entry
+        self.size += n * n
+        self.data = None
+
+    # Returns (paragraphs, n x n read-only memory-mapped score matrix).
+    def get(self, eid, question):
+        entry = self.entries[(eid, question)]
+        n = entry['n']
+        if n == 0:
+            return entry['paragraphs'], np.zeros((0, 0), dtype=DTYPE)
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=DTYPE, mode='r', shape=(self.size,))
+        return entry['paragraphs'], self.data[entry['offset']:entry['offset'] + n * n].reshape(n, n)
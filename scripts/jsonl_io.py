@@ -0,0 +1,217 @@
+# Helpers for the JSONL output files written by every pipeline stage.
+# All records go through a JsonlWriter: worker threads enqueue records and a single writer thread
+# appends them in batches, so lines never interleave and the file is not reopened per record.
+# Output paths ending in .gz or .zst are compressed (zstd needs the optional `zstandard` package).
+# After a crash the file may end in a partial line or an unfinished compressed frame;
+# repair_jsonl_output drops it before a run resumes (read_jsonl_output, count_jsonl_output and completed_keys
+# call it first), so each stage can skip the work already recorded.
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+import time
+from itertools import islice
+
+
+def compression_of(path):
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def open_compressed_reader(path):
+    if compression_of(path) == 'gzip':
+        return gzip.open(path, 'rb')
+    import zstandard
+    raw = open(path, 'rb')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True))
+
+
+def open_compressed_writer(path):
+    if compression_of(path) == 'gzip':
+        return gzip.open(path, 'wb')
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+
+
+def open_output_reader(path):
+    return open_compressed_reader(path) if compression_of(path) else open(path, 'rb')
+
+
+# Whether a zstd file ends with a complete frame: the stream reader stops at an unfinished one without an error.
+def zstd_frames_complete(path):
+    import zstandard
+    dctx = zstandard.ZstdDecompressor()
+    dobj, in_frame = dctx.decompressobj(), False
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            while chunk:
+                dobj.decompress(chunk)
+                in_frame = True
+                chunk = b''
+                if dobj.eof:
+                    chunk = dobj.unused_data
+                    dobj, in_frame = dctx.decompressobj(), False
+    return not in_frame
+
+
+# Drop a partial record left at the end of an output file by a crash: a last line without its newline,
+# a garbled last line or an unfinished compressed frame. Lines are streamed and only the last one is parsed.
+def repair_jsonl_output(path):
+    if not os.path.exists(path):
+        return
+    valid_lines = 0
+    valid_bytes = 0
+    last_line = None
+    corrupted = False
+    # Raised on an unfinished or corrupted compressed stream.
+    read_errors = (EOFError, OSError)
+    if compression_of(path) == 'zstd':
+        import zstandard
+        read_errors += (zstandard.ZstdError,)
+        corrupted = not zstd_frames_complete(path)
+    with open_output_reader(path) as f:
+        try:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    corrupted = True
+                    break
+                last_line = line
+                valid_lines += 1
+                valid_bytes += len(line)
+        except read_errors:
+            corrupted = True
+    if last_line is not None:
+        try:
+            json.loads(last_line)
+        except ValueError:
+            corrupted = True
+            valid_lines -= 1
+            valid_bytes -= len(last_line)
+    if not corrupted and (compression_of(path) or valid_bytes == os.path.getsize(path)):
+        return
+    print(f"Dropping a partially written record at the end of {path}")
+    if compression_of(path):
+        # Compressed streams cannot be truncated in place; copy the valid lines to a new file.
+        tmp_path = path + '.tmp' + os.path.splitext(path)[1]
+        with open_output_reader(path) as src, open_compressed_writer(tmp_path) as dst:
+            for line in islice(src, valid_lines):
+                dst.write(line)
+        os.replace(tmp_path, path)
+    else:
+        with open(path, 'r+b') as f:
+            f.truncate(valid_bytes)
+
+
+# Stream the complete records of an output file, after dropping a partial record left by a crash.
+def read_jsonl_output(path):
+    repair_jsonl_output(path)
+    if not os.path.exists(path):
+        return
+    with open_output_reader(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# Number of complete records in an output file, counted without parsing them.
+def count_jsonl_output(path):
+    repair_jsonl_output(path)
+    if not os.path.exists(path):
+        return 0
+    with open_output_reader(path) as f:
+        return sum(1 for _ in f)
+
+
+# Keys of the work already recorded in an output file, e.g. key_fn=lambda r: r['eid']. Records for which
+# key_fn returns None (e.g. a failed call) do not count, so a run retries them; when a key is recorded
+# more than once, readers should use the later record.
+def completed_keys(path, key_fn):
+    keys = set(key_fn(record) for record in read_jsonl_output(path))
+    keys.discard(None)
+    return keys
+
+
+class JsonlWriter:
+    def __init__(self, path, append=True, max_batch=256, flush_interval=1.0):
+        self.path = path
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.compression = compression_of(path)
+        self.raw = open(path, 'ab' if append else 'wb')
+        if self.compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='ab')
+        elif self.compression == 'zstd':
+            import zstandard
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Thread-safe; the record is written by the writer thread. An error of that thread (e.g. a full disk)
+    # is raised by the next write instead of only when the writer is closed.
+    def write(self, record):
+        self.raise_error()
+        self.queue.put([record])
+
+    def write_many(self, records):
+        self.raise_error()
+        self.queue.put(list(records))
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _flush(self, lines):
+        if lines:
+            self.stream.write(''.join(lines).encode('utf-8'))
+        if self.compression == 'gzip':
+            self.stream.flush()
+        elif self.compression == 'zstd':
+            import zstandard
+            self.stream.flush(zstandard.FLUSH_BLOCK)
+        self.raw.flush()
+
+    def _run(self):
+        lines = []
+        last_flush = time.monotonic()
+        done = False
+        while not done:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                if item is None:
+                    done = True
+                else:
+                    lines.extend(json.dumps(record) + '\n' for record in item)
+            except queue.Empty:
+                pass
+            if done or len(lines) >= self.max_batch or time.monotonic() - last_flush >= self.flush_interval:
+                try:
+                    self._flush(lines)
+                except Exception as e:
+                    self.error = e
+                lines = []
+                last_flush = time.monotonic()
+
+    # Write out everything queued, fsync and close the file.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        self.raise_error()
@@ -0,0 +1,173 @@
+# Shared asyncio-based client for the OpenAI chat API.
+# Requests run on a background event loop with a bounded number of requests in flight, and
+# requests-per-minute / tokens-per-minute token buckets keep the scripts under the account quota
+# instead of reacting to 429s after the fact. The blocking `complete` method can be called from
+# any thread, so scripts keep their existing control flow. Every call is recorded in `client.metrics`.
+import asyncio
+import os
+import random
+import threading
+import time
+import openai
+from openai.error import (APIConnectionError, APIError, InvalidRequestError, RateLimitError,
+                          ServiceUnavailableError, Timeout, TryAgain)
+from context_fitting import estimate_prompt_tokens
+from metrics import Metrics, estimate_cost
+from response_cache import ResponseCache
+
+# Errors worth retrying after a backoff sleep.
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APIError, ServiceUnavailableError, Timeout, TryAgain)
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Wait until `amount` units are available and take them.
+    async def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate)
+                self.refill()
+            self.level -= amount
+
+    # Take (or give back, if negative) units without waiting, e.g. to correct an estimate.
+    def adjust(self, amount):
+        self.refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class LLMClient:
+    def __init__(self, model, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=8, completion_tokens=512, api_base=None, request_timeout=600, cache=None, metrics=None):
+        self.model = model
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.completion_tokens = completion_tokens
+        self.api_base = api_base
+        self.request_timeout = request_timeout
+        if openai.api_key is None:
+            openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # asyncio primitives are created on the client's own loop.
+        asyncio.run_coroutine_threadsafe(self._setup(requests_per_minute, tokens_per_minute), self.loop).result()
+
+    async def _setup(self, requests_per_minute, tokens_per_minute):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    @classmethod
+    def from_args(cls, model, args):
+        cache = None
+        if args.cache_path:
+            cache = ResponseCache(args.cache_path, max_bytes=args.cache_max_mb * 1024 * 1024)
+        return cls(model, max_concurrency=args.max_concurrency, requests_per_minute=args.requests_per_minute,
+                   tokens_per_minute=args.tokens_per_minute, cache=cache, metrics=Metrics(args.metrics_path))
+
+    async def _create(self, messages):
+        kwargs = {'model': self.model, 'messages': messages, 'request_timeout': self.request_timeout}
+        if self.api_base is not None:
+            kwargs['api_base'] = self.api_base
+        return await openai.ChatCompletion.acreate(**kwargs)
+
+    # Returns the completion text, or None if the request was rejected (e.g. too long) or kept failing.
+    # `labels` (stage, eid, ...) are attached to the call's metrics record.
+    async def acomplete(self, messages, labels=None):
+        start = time.perf_counter()
+        if self.cache is not None:
+            cached = self.cache.get(self.model, messages)
+            if cached is not None:
+                self.metrics.record('llm_call', labels, model=self.model, status='cached', latency=time.perf_counter() - start)
+                return cached
+        prompt_tokens = estimate_prompt_tokens(messages)
+        estimated_tokens = prompt_tokens + self.completion_tokens
+        wait, backoff = 0.0, 0.0
+        for attempt in range(self.max_retries):
+            wait_start = time.perf_counter()
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    wait += time.perf_counter() - wait_start
+                    response = await self._create(messages)
+            except InvalidRequestError as e:
+                print(f"API Error: {e}")
+                self.metrics.record('llm_call', labels, model=self.model, status='rejected', retries=attempt,
+                                    prompt_tokens_estimate=prompt_tokens, latency=time.perf_counter() - start,
+                                    wait=wait, backoff=backoff)
+                return None
+            except RETRYABLE_ERRORS as e:
+                delay = min(60, 2 ** attempt) * (0.5 + random.random() / 2)
+                print(f"API Error: {e}. Retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                backoff += delay
+                continue
+            if self.token_bucket is not None and 'usage' in response:
+                self.token_bucket.adjust(response['usage']['total_tokens'] - estimated_tokens)
+            content = response['choices'][0]['message']['content']
+            if self.cache is not None and content is not None:
+                self.cache.put(self.model, messages, content)
+            usage = response.get('usage', {})
+            self.metrics.record('llm_call', labels, model=self.model, status='ok', retries=attempt,
+                                prompt_tokens=usage.get('prompt_tokens', prompt_tokens),
+                                completion_tokens=usage.get('completion_tokens', 0),
+                                cost=estimate_cost(self.model, usage.get('prompt_tokens', prompt_tokens), usage.get('completion_tokens', 0)),
+                                latency=time.perf_counter() - start, wait=wait, backoff=backoff)
+            return content
+        print("Failed")
+        self.metrics.record('llm_call', labels, model=self.model, status='failed', retries=self.max_retries,
+                            latency=time.perf_counter() - start, wait=wait, backoff=backoff)
+        return None
+
+    # Schedule a request on the client's loop and return a concurrent.futures.Future.
+    # The caller's metrics labels go with the request, since it runs on the client's thread.
+    def submit(self, messages):
+        return asyncio.run_coroutine_threadsafe(self.acomplete(messages, self.metrics.current_labels()), self.loop)
+
+    # Blocking call, safe to use from any thread.
+    def complete(self, messages):
+        return self.submit(messages).result()
+
+    # Run many requests concurrently and return the completions in input order.
+    def complete_many(self, prompts):
+        futures = [self.submit(messages) for messages in prompts]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        if self.cache is not None:
+            stats = self.cache.stats()
+            print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)")
+            self.cache.close()
+        print(self.metrics.summary())
+        self.metrics.close()
+
+
+# Command-line options shared by every script that talks to the API.
+def add_client_args(parser):
+    parser.add_argument('--max_concurrency', type=int, default=8, help="Maximum number of requests in flight.")
+    parser.add_argument('--requests_per_minute', type=int, default=None, help="Request rate limit, unlimited if unset.")
+    parser.add_argument('--tokens_per_minute', type=int, default=None, help="Token rate limit, unlimited if unset.")
+    parser.add_argument('--cache_path', type=str, default="llm_cache.sqlite", help="Response cache file. Pass '' to disable.")
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help="Size bound of the response cache.")
+    parser.add_argument('--metrics_path', type=str, default=None, help="JSONL trace of every API call and truncation search.")
@@ -0,0 +1,68 @@
+# Local replacement for the LLM extraction stage of prompt_standard_llm.py.
+# Sentences of all articles of an event are embedded as TF-IDF vectors (IDF over the event's sentences),
+# each sentence is scored by its centrality within its article plus its similarity to the event as a
+# whole, and the top sentences of each article are kept, skipping those that repeat a sentence already
+# selected from this or an earlier article. The output has the structure of the parsed LLM extraction,
+# one list of 'Sentence N: ...' lines per article, so format_prompt_summary takes it unchanged.
+import re
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def split_sentences(article):
+    from nltk import sent_tokenize
+    return [sentence.strip() for sentence in sent_tokenize(article) if TOKEN_PATTERN.search(sentence)]
+
+
+# Rows of L2-normalized TF-IDF vectors, one per sentence.
+def tfidf_vectors(sentences):
+    vocab = {}
+    rows, cols = [], []
+    for row, sentence in enumerate(sentences):
+        for token in TOKEN_PATTERN.findall(sentence.lower()):
+            rows.append(row)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    counts = np.zeros((len(sentences), max(len(vocab), 1)))
+    np.add.at(counts, (rows, cols), 1)
+    document_frequency = (counts > 0).sum(axis=0)
+    vectors = np.log1p(counts) * (np.log((1 + len(sentences)) / (1 + document_frequency)) + 1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# Top `num_sentences` sentences of each article, most important first.
+# `event_weight` balances similarity to the whole event against centrality within the article, and
+# sentences whose cosine similarity to an already selected one exceeds `redundancy` are skipped.
+def extract_sentences(articles, num_sentences=10, event_weight=0.5, redundancy=0.7):
+    article_sentences = [split_sentences(article) for article in articles]
+    sentences = [sentence for article in article_sentences for sentence in article]
+    if not sentences:
+        return [[] for _ in articles]
+    vectors = tfidf_vectors(sentences)
+    similarity = vectors @ vectors.T
+    article_ids = np.repeat(np.arange(len(articles)), [len(article) for article in article_sentences])
+    same_article = article_ids[:, None] == article_ids[None, :]
+    np.fill_diagonal(similarity, 0)
+
+    # Mean similarity to the other sentences of the same article, and to the sentences of other articles.
+    sizes = np.maximum(same_article.sum(axis=1) - 1, 1)
+    centrality = (similarity * same_article).sum(axis=1) / sizes
+    others = np.maximum(len(sentences) - sizes - 1, 1)
+    event_similarity = (similarity * ~same_article).sum(axis=1) / others
+    scores = (1 - event_weight) * centrality + event_weight * event_similarity
+
+    extracted = []
+    selected = np.zeros(len(sentences), dtype=bool)
+    for article_idx in range(len(articles)):
+        candidates = np.nonzero(article_ids == article_idx)[0]
+        picked = []
+        for i in candidates[np.argsort(-scores[candidates], kind='stable')]:
+            if len(picked) == num_sentences:
+                break
+            if selected.any() and similarity[i, selected].max() > redundancy:
+                continue
+            selected[i] = True
+            picked.append(i)
+        extracted.append([f"Sentence {rank + 1}: {sentences[i]}" for rank, i in enumerate(picked)])
+    return extracted
@@ -0,0 +1,116 @@
+# Structured run metrics. Every LLM call, context-fitting search and consolidation model batch is
+# recorded with its kind, stage and event id, written to an optional JSONL trace and summed per
+# (kind, stage) for an end-of-run summary with estimated API cost. Components take an optional
+# `metrics` argument and only call `record` on it, so they run unchanged without one.
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from jsonl_io import JsonlWriter
+
+# USD per 1K (prompt, completion) tokens.
+PRICES = {
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+}
+
+# Labels (stage, eid, ...) attached to the records made in the current thread or task.
+LABELS = contextvars.ContextVar('metrics_labels', default={})
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    return prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price
+
+
+class Metrics:
+    def __init__(self, path=None):
+        self.writer = JsonlWriter(path) if path else None
+        self.lock = threading.Lock()
+        # (kind, stage) -> {field: sum}, and (kind, stage) -> latencies
+        self.totals = {}
+        self.latencies = {}
+
+    # Labels for the records made inside the block, e.g. `with metrics.labels(stage='qa', eid=eid):`.
+    # Records made on another thread need the labels passed explicitly (see current_labels).
+    @contextmanager
+    def labels(self, **labels):
+        token = LABELS.set({**LABELS.get(), **labels})
+        try:
+            yield
+        finally:
+            LABELS.reset(token)
+
+    def current_labels(self):
+        return dict(LABELS.get())
+
+    # Numeric fields are summed and string 'status' fields counted per (kind, stage).
+    def record(self, kind, labels=None, **fields):
+        record = {'kind': kind, 'time': time.time(), **self.current_labels(), **(labels or {}), **fields}
+        key = (kind, record.get('stage', ''))
+        with self.lock:
+            totals = self.totals.setdefault(key, {'count': 0})
+            totals['count'] += 1
+            for name, value in fields.items():
+                if name == 'status':
+                    totals[f'status_{value}'] = totals.get(f'status_{value}', 0) + 1
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals[name] = totals.get(name, 0) + value
+            if 'latency' in fields:
+                self.latencies.setdefault(key, []).append(fields['latency'])
+        if self.writer is not None:
+            self.writer.write(record)
+
+    # Hand the sums recorded so far to another process's Metrics (see merge) and reset them.
+    def take_totals(self):
+        with self.lock:
+            state = (self.totals, self.latencies)
+            self.totals, self.latencies = {}, {}
+        return state
+
+    def merge(self, state):
+        totals, latencies = state
+        with self.lock:
+            for key, fields in totals.items():
+                own = self.totals.setdefault(key, {})
+                for name, value in fields.items():
+                    own[name] = own.get(name, 0) + value
+            for key, values in latencies.items():
+                self.latencies.setdefault(key, []).extend(values)
+
+    def summary(self):
+        lines = []
+        total_cost = 0.0
+        with self.lock:
+            for (kind, stage), totals in sorted(self.totals.items()):
+                latencies = self.latencies.get((kind, stage), [])
+                noun = {'llm_call': 'calls', 'fit': 'searches', 'model_batch': 'batches'}.get(kind, 'records')
+                details = []
+                if kind == 'llm_call':
+                    details.append(' '.join(f"{name[len('status_'):]} {value}" for name, value in sorted(totals.items()) if name.startswith('status_')))
+                    details.append(f"{totals.get('retries', 0)} retries")
+                    details.append(f"{totals.get('prompt_tokens', 0)} prompt + {totals.get('completion_tokens', 0)} completion tokens")
+                    details.append(f"~${totals.get('cost', 0.0):.2f}")
+                    details.append(f"{totals.get('backoff', 0.0):.1f}s backoff, {totals.get('wait', 0.0):.1f}s queued for rate limits or a free slot")
+                    total_cost += totals.get('cost', 0.0)
+                elif kind == 'fit':
+                    details.append(f"{totals.get('probes', 0)} requests, {totals.get('truncated', 0)} truncated, {totals.get('failed', 0)} failed")
+                elif kind == 'relevance_filter':
+                    pairs = totals.get('skipped', 0) + totals.get('sent', 0)
+                    details.append(f"{totals.get('skipped', 0)} of {pairs} (question, article) calls skipped as irrelevant")
+                elif kind == 'model_batch':
+                    padding = 1 - totals.get('tokens', 0) / max(totals.get('padded_tokens', 0), 1)
+                    details.append(f"{totals.get('batch_size', 0)} sequences, padding ratio {padding:.1%}")
+                if latencies:
+                    details.append(f"latency total {sum(latencies):.1f}s p50 {np.percentile(latencies, 50):.3f}s p99 {np.percentile(latencies, 99):.3f}s")
+                lines.append(f"{kind}[{stage or '-'}]: {totals['count']} {noun}" + ''.join(f", {detail}" for detail in details))
+        if total_cost:
+            lines.append(f"Estimated API cost: ${total_cost:.2f}")
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
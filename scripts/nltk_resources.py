@@ -0,0 +1,29 @@
+# NLTK data needed by the scripts, looked up on disk before anything touches the network.
+# ensure_punkt replaces the unconditional nltk.download('punkt') the scripts used to run at import time,
+# which made a request on every start (and hung on machines without network access). A missing resource
+# is downloaded once, unless NLTK_OFFLINE is set, in which case the run stops with instructions instead.
+import os
+
+
+def punkt_resource():
+    import nltk
+    # NLTK >= 3.8.2 tokenizes with the pickle-free 'punkt_tab' data.
+    return 'punkt_tab' if hasattr(nltk.tokenize, 'PunktTokenizer') else 'punkt'
+
+
+def ensure_resource(package, path):
+    import nltk
+    try:
+        nltk.data.find(path)
+        return
+    except LookupError:
+        pass
+    if os.environ.get('NLTK_OFFLINE'):
+        raise SystemExit(f"NLTK resource '{package}' not found in {nltk.data.path}. Run `python -m nltk.downloader {package}` "
+                         f"on a machine with network access and copy the nltk_data directory to one of these paths, or set NLTK_DATA.")
+    nltk.download(package, quiet=True)
+
+
+def ensure_punkt():
+    package = punkt_resource()
+    ensure_resource(package, f'tokenizers/{package}')
@@ -1,43 +1,28 @@
 import openai
-import backoff
-from openai.error import RateLimitError
-from glob import glob
 import json
 import os
-import pandas as pd
 from tqdm import tqdm
-from nltk import word_tokenize
 import argparse
-import os
-import nltk
-nltk.download('punkt')
+from concurrent.futures import ThreadPoolExecutor
+from context_fitting import fit_to_context, prompt_budget
+from token_cache import TokenCache, cache_path_for
+from llm_client import LLMClient, add_client_args
+from jsonl_io import JsonlWriter, completed_keys
+from nltk_resources import ensure_punkt
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--output_path', type=str, required=True)
+add_client_args(parser)
 args = parser.parse_args()
+ensure_punkt()
 
 
 
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
-@backoff.on_exception(backoff.expo, RateLimitError)
-def response_API(prompt, myKwargs = {}):
-    
-    try:
-        response = openai.ChatCompletion.create(
-        model='gpt-3.5-turbo-16k',
-        messages=prompt
-        )   
-        
-    except openai.error.APIConnectionError:
-        print("Failed")
-        return None
-    except openai.error.InvalidRequestError as e:
-        print("InvalidRequestError Failed")
-        print(e)
-        return None
-    
-    return response['choices'][0]['message']['content']
+MODEL_NAME = 'gpt-3.5-turbo-16k'
+
+client = LLMClient.from_args(MODEL_NAME, args)
 
 
 
@@ -49,10 +34,7 @@ def format_prompt_summary(articles, max_tokens=10000):
     for article_idx, article in enumerate(articles):
         sentences_string += f"Article {article_idx} \n ==== \n"
         
-        if len(word_tokenize(article)) > max_tokens:
-            article_string = ' '.join(word_tokenize(article)[:max_tokens])
-        else:
-            article_string = article
+        article_string = token_cache.truncate(article, max_tokens)
         sentences_string += article_string
         sentences_string += "\n"
     
@@ -68,39 +50,46 @@ def format_prompt_summary(articles, max_tokens=10000):
     
     return messages
 
-with open("../data/diverse_summ.json", "r") as f:
+DATA_PATH = "../data/diverse_summ.json"
+with open(DATA_PATH, "r") as f:
     diverse_summ = json.load(f)
 
+# Token offsets of every article, computed once and reused across runs.
+token_cache = TokenCache(cache_path_for(DATA_PATH))
 
-for instance in tqdm(diverse_summ, desc='Generating summaries: '):
-    
-    
-    # Gather eid and articles
+def summarize_event(instance):
     eid = instance['eid']
 
     # We only take the content for each article.
     articles = [article['content'] for article in instance["articles"]]
 
-    prompt = format_prompt_summary(articles)
-    try:
-        generated_summary = response_API(prompt)
-    except:
-        generated_summary = None
-
-    if generated_summary is None:
-
-        # Truncate the input until it fits the context window.
-        for max_tokens in range(16000, 1, -1):
-            prompt = format_prompt_summary(articles, max_tokens)
-            try:
-                generated_summary = response_API(prompt)
-            except:
-                generated_summary = None
-
-
-    with open(args.output_path,'a') as f:
-        f.write(json.dumps({'summary': generated_summary,
-                            'eid':eid}) + '\n')
-
-            
-            
+    # Truncate the input until it fits the context window.
+    with client.metrics.labels(stage='summary', eid=eid):
+        fit = fit_to_context(lambda max_tokens: format_prompt_summary(articles, max_tokens),
+                             client.complete, budget=prompt_budget(MODEL_NAME), high=10000, metrics=client.metrics)
+    generated_summary = fit.response
+    if fit.probes > 1 or fit.value < 10000:
+        tqdm.write(f"{eid}: truncated to max_tokens={fit.value} after {fit.probes} probes")
+
+    return {'summary': generated_summary,
+            'eid':eid}
+
+# Skip the events already summarized by a previous run; events without a summary are tried again.
+completed_eids = completed_keys(args.output_path, lambda record: record['eid'] if record['summary'] is not None else None)
+
+# Events are summarized concurrently, so LLMClient can use its whole concurrency and rate limits; at most
+# a few events per request slot are queued, and results are written in dataset order. The writer is closed
+# (flushing what is queued) even if an event fails.
+pending = []
+with JsonlWriter(args.output_path) as writer, ThreadPoolExecutor(max_workers=args.max_concurrency) as event_pool:
+    for instance in tqdm(diverse_summ, desc='Generating summaries: '):
+        if instance['eid'] in completed_eids:
+            continue
+        pending.append(event_pool.submit(summarize_event, instance))
+        while len(pending) > 2 * args.max_concurrency:
+            writer.write(pending.pop(0).result())
+    for future in pending:
+        writer.write(future.result())
+
+token_cache.save()
+client.close()
@@ -1,51 +1,40 @@
 import openai
-import backoff
-from openai.error import RateLimitError
-from glob import glob
+import hashlib
 import json
 import os
-import pandas as pd
 from tqdm import tqdm
-from nltk import word_tokenize
 import argparse
-import os
-import nltk
-nltk.download('punkt')
+from concurrent.futures import ThreadPoolExecutor
+from context_fitting import fit_to_context, prompt_budget
+from token_cache import TokenCache, cache_path_for
+from llm_client import LLMClient, add_client_args
+from jsonl_io import JsonlWriter, completed_keys, read_jsonl_output
+import local_extractor
+from nltk_resources import ensure_punkt
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--output_path', type=str, required=True)
+parser.add_argument('--extractor', type=str, default='llm', choices=['llm', 'local'], help="'local' picks the sentences with TF-IDF centrality instead of one LLM call per article.")
+parser.add_argument('--pipeline_depth', type=int, default=2, help="Events in flight at once, so the summary of one event overlaps the extraction of the next.")
+parser.add_argument('--extraction_cache_path', type=str, default="extraction_cache.jsonl", help="Per-article extractions reused by later runs (e.g. with a new summary prompt). Pass '' to disable.")
+add_client_args(parser)
 args = parser.parse_args()
+ensure_punkt()
 
 
 
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
-@backoff.on_exception(backoff.expo, RateLimitError)
-def response_API(prompt, myKwargs = {}):
-    
-    try:
-        response = openai.ChatCompletion.create(
-        model='gpt-4',
-        messages=prompt
-        )   
-        
-    except openai.error.APIConnectionError:
-        print("Failed")
-        return None
-    except openai.error.InvalidRequestError as e:
-        print("InvalidRequestError Failed")
-        print(e)
-        return None
-    
-    return response['choices'][0]['message']['content']
+MODEL_NAME = 'gpt-4'
+
+client = LLMClient.from_args(MODEL_NAME, args)
 
 
 
 def format_prompt_extraction(article, max_tokens=4000):
     
     # Truncate the input if longer than max_tokens.    
-    if len(word_tokenize(article)) > max_tokens:
-        article = ' '.join(word_tokenize(article)[:max_tokens])
+    article = token_cache.truncate(article, max_tokens)
     
     messages= [{"role": "system", "content": "You are a helpful assistant that reads instructions carefully."},
     {"role": "user", "content": f"""Read the following news article. Extract the most important 10 sentences from the article and do not change words in the sentences. Your extracted sentence must be in a structured format: 'Sentence 1: [sentence 1] \n Sentence 2: [sentence 2] \n Sentence 3: [sentence 3] ...' where [sentence 1] should be the most important sentence.
@@ -78,59 +67,99 @@ def format_prompt_summary(sentences, max_sentences=10):
 def parse_sentences(sentences_string):
     return sentences_string.split('\n')
 
-with open("../data/diverse_summ.json", "r") as f:
+DATA_PATH = "../data/diverse_summ.json"
+with open(DATA_PATH, "r") as f:
     diverse_summ = json.load(f)
 
-
-for instance in tqdm(diverse_summ, desc='Generating summaries: '):
-    
+# Token offsets of every article, computed once and reused across runs.
+token_cache = TokenCache(cache_path_for(DATA_PATH))
+
+# Extracted sentences by article hash, from previous runs.
+extraction_cache = {}
+extraction_writer = None
+if args.extraction_cache_path:
+    extraction_cache = {record['key']: record['sentences'] for record in read_jsonl_output(args.extraction_cache_path)}
+    extraction_writer = JsonlWriter(args.extraction_cache_path)
+
+def article_key(article):
+    return hashlib.sha1(f"{MODEL_NAME}\0{article}".encode('utf-8')).hexdigest()
+
+def extract_sentences(eid, article):
+    key = article_key(article)
+    if key in extraction_cache:
+        return extraction_cache[key]
+
+    # Truncate the input until it fits the context window.
+    with client.metrics.labels(stage='extraction', eid=eid):
+        fit = fit_to_context(lambda max_tokens: format_prompt_extraction(article=article, max_tokens=max_tokens),
+                             client.complete, budget=prompt_budget(MODEL_NAME), high=4000, metrics=client.metrics)
+    extracted_sentences = fit.response
+    if fit.probes > 1:
+        tqdm.write(f"{eid}: extraction truncated to max_tokens={fit.value} after {fit.probes} probes")
+    if extracted_sentences is None:
+        # The call failed or no truncation fits the context window; not cached, so a later run tries again.
+        tqdm.write(f"{eid}: no extraction for an article")
+        return None
     
-    # Gather eid and articles
+    parsed_extracted_sentences = parse_sentences(extracted_sentences)
+    extraction_cache[key] = parsed_extracted_sentences
+    if extraction_writer is not None:
+        extraction_writer.write({'key': key, 'sentences': parsed_extracted_sentences})
+    return parsed_extracted_sentences
+
+# Extraction calls of all events share one pool; LLMClient bounds the requests actually in flight.
+extraction_pool = ThreadPoolExecutor(max_workers=args.max_concurrency)
+
+def summarize_event(instance):
     eid = instance['eid']
 
     # We only take the content for each article
     articles = [article['content'] for article in instance["articles"]]
 
-    # Extract important sentences from articles
-    all_extracted_sentences = []        
-    for article in articles:
-        prompt = format_prompt_extraction(article=article)
-        try:
-            extracted_sentences = response_API(prompt)
-        except:
-            extracted_sentences = None
-        if extracted_sentences is None:
-            
-            # Truncate the input until it fits the context window.
-            for max_tokens in range(4000, 1, -1):
-                
-                prompt = format_prompt_extraction(article=article, max_tokens=max_tokens)
-                try:
-                    extracted_sentences = response_API(prompt)
-                except:
-                    extracted_sentences = None
-                if extracted_sentences is not None:
-                    break
-        
-        parsed_extracted_sentences = parse_sentences(extracted_sentences)
-
-        all_extracted_sentences.append(parsed_extracted_sentences)
+    # Extract important sentences from all articles concurrently
+    if args.extractor == 'local':
+        all_extracted_sentences = local_extractor.extract_sentences(articles)
+    else:
+        all_extracted_sentences = list(extraction_pool.map(lambda article: extract_sentences(eid, article), articles))
+    # Without the sentences of every article there is nothing to summarize; the None summary is retried
+    # by the next run.
+    if any(sentences is None for sentences in all_extracted_sentences):
+        return {'summary': None,
+                'extracted_sentences': all_extracted_sentences,
+                'eid':eid}
 
     # Generate summary based on articles
-    prompt = format_prompt_summary(all_extracted_sentences)
-    generated_summary = response_API(prompt)
-    if generated_summary is None:
-
-        # Truncate the input until it fits the context window.
-        for max_sentences in range(10, 1, -1):
-            prompt = format_prompt_summary(all_extracted_sentences, max_sentences)
-            generated_summary = response_API(prompt)
-
-
-    with open(args.output_path,'a') as f:
-        f.write(json.dumps({'summary': generated_summary,
-                            'extracted_sentences': all_extracted_sentences,
-                            'eid':eid}) + '\n')
-
-            
-            
+    # Truncate the input until it fits the context window.
+    with client.metrics.labels(stage='summary', eid=eid):
+        fit = fit_to_context(lambda max_sentences: format_prompt_summary(all_extracted_sentences, max_sentences),
+                             client.complete, budget=prompt_budget(MODEL_NAME), high=10, low=2, metrics=client.metrics)
+    generated_summary = fit.response
+    if fit.probes > 1:
+        tqdm.write(f"{eid}: summary truncated to max_sentences={fit.value} after {fit.probes} probes")
+
+    return {'summary': generated_summary,
+            'extracted_sentences': all_extracted_sentences,
+            'eid':eid}
+
+# Skip the events already summarized by a previous run; events without a summary are tried again.
+completed_eids = completed_keys(args.output_path, lambda record: record['eid'] if record['summary'] is not None else None)
+
+# Up to pipeline_depth events run at once; results are written in dataset order. The writers are closed
+# (flushing what is queued) even if an event fails.
+pending = []
+try:
+    with JsonlWriter(args.output_path) as writer, ThreadPoolExecutor(max_workers=args.pipeline_depth) as event_pool:
+        for instance in tqdm(diverse_summ, desc='Generating summaries: '):
+            if instance['eid'] in completed_eids:
+                continue
+            pending.append(event_pool.submit(summarize_event, instance))
+            while len(pending) >= args.pipeline_depth:
+                writer.write(pending.pop(0).result())
+        for future in pending:
+            writer.write(future.result())
+finally:
+    extraction_pool.shutdown()
+    if extraction_writer is not None:
+        extraction_writer.close()
+token_cache.save()
+client.close()
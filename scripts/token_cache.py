@@ -0,0 +1,145 @@
+# Cache of word_tokenize token offsets, keyed by a hash of the article content.
+# Articles are tokenized once and the character offset at which each token ends is stored, so that
+# counting tokens is a lookup and truncating to N tokens is a slice of the original string.
+# The cache is persisted in SQLite next to the data file it was built for. Only the offsets of the most
+# recently used articles are kept in memory; the others are read back from disk when needed.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+CACHE_VERSION = 2
+
+# word_tokenize rewrites double quotes as `` or ''.
+QUOTE_TOKENS = {'``', "''"}
+
+
+# Default location of the cache for a data file, e.g. diverse_summ.json -> diverse_summ.token_cache.sqlite
+def cache_path_for(data_path):
+    return os.path.splitext(data_path)[0] + '.token_cache.sqlite'
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# Character offsets at which each word_tokenize token ends.
+def token_end_offsets(text):
+    # Imported here so that scripts which never tokenize do not pay for importing nltk.
+    from nltk import word_tokenize
+    ends = []
+    point = 0
+    for token in word_tokenize(text):
+        candidates = [token, '"'] if token in QUOTE_TOKENS else [token]
+        starts = [(text.find(candidate, point), candidate) for candidate in candidates]
+        starts = [(start, candidate) for start, candidate in starts if start >= 0]
+        if not starts:
+            # The tokenizer changed the token beyond recognition; keep the current position.
+            ends.append(point)
+            continue
+        start, candidate = min(starts)
+        point = start + len(candidate)
+        ends.append(point)
+    return ends
+
+
+class TokenCache:
+    def __init__(self, path=None, max_in_memory=1024, commit_every=256):
+        self.path = path
+        self.max_in_memory = max_in_memory
+        self.commit_every = commit_every
+        # content hash -> token end offsets, least recently used first.
+        self.offsets = OrderedDict()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS offsets (key TEXT PRIMARY KEY, ends BLOB NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = self.conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+            if row is None or int(row[0]) != CACHE_VERSION:
+                self.conn.execute("DELETE FROM offsets")
+                self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('version', ?)", (str(CACHE_VERSION),))
+                self.conn.commit()
+
+    def remember(self, key, ends):
+        self.offsets[key] = ends
+        self.offsets.move_to_end(key)
+        while len(self.offsets) > self.max_in_memory:
+            self.offsets.popitem(last=False)
+
+    def lookup(self, key):
+        with self.lock:
+            ends = self.offsets.get(key)
+            if ends is not None:
+                self.offsets.move_to_end(key)
+                return ends
+            if self.conn is None:
+                return None
+            row = self.conn.execute("SELECT ends FROM offsets WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            ends = array('I', row[0]).tolist()
+            self.remember(key, ends)
+            return ends
+
+    def token_ends(self, text):
+        key = content_hash(text)
+        ends = self.lookup(key)
+        if ends is None:
+            ends = token_end_offsets(text)
+            with self.lock:
+                self.remember(key, ends)
+                if self.conn is not None:
+                    self.conn.execute("INSERT OR REPLACE INTO offsets (key, ends) VALUES (?, ?)", (key, array('I', ends).tobytes()))
+                    self.pending += 1
+                    if self.pending >= self.commit_every:
+                        self.conn.commit()
+                        self.pending = 0
+        return ends
+
+    def num_tokens(self, text):
+        return len(self.token_ends(text))
+
+    # Truncate text to its first max_tokens tokens.
+    def truncate(self, text, max_tokens):
+        ends = self.token_ends(text)
+        if len(ends) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ''
+        return text[:ends[max_tokens - 1]]
+
+    def warm(self, texts):
+        for text in texts:
+            self.token_ends(text)
+
+    # Commit the offsets tokenized since the last commit.
+    def save(self):
+        if self.conn is None:
+            return
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+
+if __name__ == "__main__":
+    import argparse
+    from tqdm import tqdm
+
+    # Prebuild the cache for every article of a DiverseSumm-format file.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default="../data/diverse_summ.json")
+    args = parser.parse_args()
+
+    with open(args.data_path, "r") as f:
+        instances = json.load(f)
+    token_cache = TokenCache(cache_path_for(args.data_path))
+    for instance in tqdm(instances, desc='Tokenizing articles: '):
+        token_cache.warm(article['content'] for article in instance['articles'])
+    token_cache.save()